@@ -13,27 +13,30 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import multiprocessing
 import os
 import sys
-import generate
 import share
-from flask import Flask, request, render_template, redirect, url_for, jsonify, send_from_directory
+import jobs
+import cache
+import composites
+import fonts
+import links
+import retry
+import router
+import storage
+from flask import Flask, Response, request, render_template, redirect, url_for, jsonify, send_from_directory, stream_with_context
 from werkzeug.utils import secure_filename
 from PIL import Image
 from io import BytesIO
 import uuid
+import json
 
 app = Flask(__name__, template_folder='.')
 
-# Determine the base directory for uploads
-if getattr(sys, 'frozen', False):
-    # PyInstaller 打包后的环境，使用二进制文件所在目录
-    base_dir = os.path.dirname(sys.executable)
-else:
-    # 开发环境，使用当前工作目录
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-
-app.config['UPLOAD_FOLDER'] = os.path.join(base_dir, 'uploads')
+# Next to the binary in PyInstaller builds, next to the sources otherwise;
+# storage.py decides where each file goes below it
+app.config['UPLOAD_FOLDER'] = storage.get_root()
 
 # Create the uploads directory if it doesn't exist
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
@@ -54,7 +57,26 @@ def dream_canvas():
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_from_directory(storage.directory(filename), filename)
+
+@app.route('/s/<filename>')
+def shared_file(filename):
+    """Serves a composite to whoever scanned a QR code of the local share backend."""
+    remaining = links.verify(filename, request.args.get('expires'), request.args.get('sig'))
+    if remaining is None:
+        return jsonify({'error': 'Invalid link'}), 403
+    if remaining == 0:
+        return jsonify({'error': 'This link has expired'}), 410
+    # Composite names are content hashes, so the file behind a link never changes
+    response = send_from_directory(storage.directory(filename), filename, max_age=remaining)
+    response.cache_control.immutable = True
+    return response
+
+def render_busy_response(error):
+    print(f"Rejecting composite request: {error}")
+    response = jsonify({'error': 'Too many requests, please retry later'})
+    response.headers['Retry-After'] = '5'
+    return response, 503
 
 @app.route('/share', methods=['POST'])
 def share_dream():
@@ -68,16 +90,19 @@ def share_dream():
 
     # 1. Create the composite image
     try:
-        composite_filename = share.create_composite_image(image_filename, text, name)
+        composite_filename = composites.get_composite(image_filename, text, name)
+    except composites.RenderBusyError as e:
+        return render_busy_response(e)
     except Exception as e:
         print(f"Error creating composite image: {e}")
         return jsonify({'error': 'Could not create composite image'}), 500
 
     # 2. Share the composite image and get QR code
-    qr_filename = share.share(composite_filename)
-    if qr_filename:
-        qr_code_url = url_for('uploaded_file', filename=qr_filename, _external=True)
-        return jsonify({'qr_code_url': qr_code_url})
+    shared = share.share(composite_filename, base_url=request.host_url)
+    if shared:
+        share_url, qr_code_url = shared
+        # The QR code is an inline data URI, so the page needs no second request
+        return jsonify({'qr_code_url': qr_code_url, 'share_url': share_url})
     else:
         return jsonify({'error': 'Could not share image'}), 500
 
@@ -92,43 +117,198 @@ def download_composite():
         return jsonify({'error': 'Missing image_filename, text, or name'}), 400
 
     try:
-        composite_filename = share.create_composite_image(image_filename, text, name)
-        return send_from_directory(app.config['UPLOAD_FOLDER'], composite_filename, as_attachment=True)
+        composite_filename = composites.get_composite(image_filename, text, name)
+        return send_from_directory(storage.directory(composite_filename), composite_filename, as_attachment=True)
+    except composites.RenderBusyError as e:
+        return render_busy_response(e)
     except Exception as e:
         print(f"Error creating composite image: {e}")
         return jsonify({'error': 'Could not create composite image'}), 500
 
+_result_cache = None
+
+def get_result_cache():
+    """
+    Returns the cache of finished generations, or None if it is disabled.
+    """
+    global _result_cache
+    if not config.get_bool_setting('cache', 'results'):
+        return None
+    if _result_cache is None:
+        _result_cache = cache.DiskCache(
+            os.path.join(app.config['UPLOAD_FOLDER'], 'cache', 'results'),
+            max_entries=config.get_int_setting('cache', 'result_max_entries'),
+            ttl=config.get_int_setting('cache', 'result_ttl'),
+        )
+    return _result_cache
+
+def get_cached_result(cache_key):
+    result_cache = get_result_cache()
+    if result_cache is None:
+        return None
+    result = result_cache.get(cache_key)
+    if result and not storage.exists(result['image_filename']):
+        # The generated image was removed, the entry is useless now
+        result_cache.delete(cache_key)
+        return None
+    return result
+
+def run_generation(job, service, dream, filepath, cache_key=None):
+    # The budget starts when a worker picks the job up, not while it waits in the queue
+    deadline = retry.Deadline.default()
+    generated_text, image_filename = router.generate_dream(service, dream, filepath, on_text=job.append_text,
+                                                           on_image=job.set_image, on_reset=job.reset_text,
+                                                           deadline=deadline)
+    if not (generated_text and image_filename):
+        raise RuntimeError('Something went wrong')
+    result = {'generated_text': generated_text, 'image_filename': image_filename}
+    result_cache = get_result_cache()
+    if cache_key and result_cache is not None:
+        result_cache.set(cache_key, result)
+    # Most users click Share next; have the composite ready by then
+    composites.speculate(image_filename, generated_text, job.name)
+    return result
+
 @app.route('/generate', methods=['POST'])
 def generate_dream():
     dream = request.form['dream']
-    filename = secure_filename(request.files['photo'].filename)
     name = request.form['name']
-    if not os.path.exists(app.config['UPLOAD_FOLDER']):
-        os.makedirs(app.config['UPLOAD_FOLDER'])
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    request.files['photo'].save(filepath)
-    
     api_service = request.form['api_service']
 
-    if api_service == 'gemini':
-        generated_text, image_filename = generate.generate_dream_image_and_plan(dream, filepath)
-    elif api_service == 'qwen':
-        generated_text, image_filename = generate.generate_dream_image_and_plan_qwen(dream, filepath)
-    elif api_service == 'doubao':
-        generated_text, image_filename = generate.generate_dream_image_and_plan_doubao(dream, filepath)
-    else:
+    service = router.resolve(api_service)
+    if service is None:
         return jsonify({'error': 'Invalid API service selected'}), 400
-    
-    if generated_text and image_filename:
-        return render_template('DreamViewer.html', name=name, generated_text=generated_text, image_filename=image_filename)
-    else:
+
+    photo = request.files['photo'].read()
+    # Resubmissions of the same photo and dream are served from the result cache
+    cache_key = cache.make_key(service, cache.normalize_dream(dream), photo)
+    cached_result = get_cached_result(cache_key)
+    if cached_result:
+        job = jobs.get_queue().complete(name, cached_result)
+        composites.speculate(cached_result['image_filename'], cached_result['generated_text'], name)
+        return jsonify({
+            'job_id': job.id,
+            'status_url': url_for('job_status', job_id=job.id),
+            'view_url': url_for('job_view', job_id=job.id),
+        }), 200
+
+    # Prefix a random id so concurrent uploads with the same name don't clash
+    filename = "{}_{}".format(uuid.uuid4().hex, secure_filename(request.files['photo'].filename))
+    filepath = storage.new_path(filename)
+    with open(filepath, 'wb') as photo_file:
+        photo_file.write(photo)
+
+    try:
+        # A double-click joins the job that is already running for the same input
+        job = jobs.get_queue().submit(name, run_generation, service, dream, filepath,
+                                      cache_key=cache_key, dedupe_key=cache.make_key(cache_key, name))
+    except jobs.QueueFullError as e:
+        print(f"Rejecting generation request: {e}")
+        response = jsonify({'error': 'Too many requests, please retry later'})
+        response.headers['Retry-After'] = '10'
+        return response, 503
+
+    return jsonify({
+        'job_id': job.id,
+        'status_url': url_for('job_status', job_id=job.id),
+        'view_url': url_for('job_view', job_id=job.id),
+    }), 202
+
+@app.route('/providers')
+def provider_health():
+    return jsonify({'ranking': router.rank_providers(), 'providers': router.health()})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = jobs.get_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    response = jsonify(job.to_dict())
+    if job.retry_after is not None:
+        response.headers['Retry-After'] = str(job.retry_after)
+    return response
+
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    job = jobs.get_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    # EventSource sends the id ("<text resets>:<chunks>") of the last event it saw when it reconnects
+    try:
+        resets_seen, chunks_sent = (int(part) for part in request.headers.get('Last-Event-ID', '').split(':'))
+    except ValueError:
+        resets_seen, chunks_sent = 0, 0
+
+    def sse(event, data, event_id=None):
+        message = f"event: {event}\n"
+        if event_id is not None:
+            message += f"id: {event_id}\n"
+        return message + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    def events():
+        sent = chunks_sent
+        resets = resets_seen
+        image_sent = None
+        version = None
+        while True:
+            snapshot = job.wait_for_update(version, timeout=15)
+            if snapshot['version'] == version:
+                # Keep the connection open through proxies while the provider is busy
+                yield ": keep-alive\n\n"
+                continue
+            version = snapshot['version']
+            status = snapshot['status']
+            if snapshot['text_resets'] != resets:
+                # Another provider took over; the page drops the text it has so far
+                resets = snapshot['text_resets']
+                sent = 0
+                image_sent = None
+                yield sse('reset', {})
+            for chunk in snapshot['text_chunks'][sent:]:
+                sent += 1
+                yield sse('plan', {'delta': chunk}, event_id=f"{resets}:{sent}")
+            if snapshot['image_filename'] and snapshot['image_filename'] != image_sent:
+                image_sent = snapshot['image_filename']
+                yield sse('image', {'image_filename': image_sent})
+            if status == jobs.DONE:
+                yield sse('done', job.to_dict())
+                return
+            if status == jobs.FAILED:
+                yield sse('failed', job.to_dict())
+                return
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers=headers)
+
+@app.route('/jobs/<job_id>/view')
+def job_view(job_id):
+    job = jobs.get_queue().get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if job.status == jobs.FAILED:
+        if job.retry_after is not None:
+            response = jsonify({'error': 'busy', 'retry_after': job.retry_after})
+            response.headers['Retry-After'] = str(job.retry_after)
+            return response, 429
         return jsonify({'error': 'Something went wrong'}), 500
+    if job.status == jobs.DONE:
+        return render_template('DreamViewer.html', name=job.name, generated_text=job.result['generated_text'],
+                               image_filename=job.result['image_filename'], job_id=job.id, job_done=True)
+    # Render right away; the page fills in text and image from /jobs/<id>/stream
+    return render_template('DreamViewer.html', name=job.name, generated_text='',
+                           image_filename=None, job_id=job.id, job_done=False)
 
 def open_browser():
     webbrowser.open_new("http://127.0.0.1:5001/")
 
 if __name__ == '__main__':
+    # Composite render workers are separate processes; needed for PyInstaller builds
+    multiprocessing.freeze_support()
     config.init_config()
+    fonts.preload()
+    # Deletes old photos, generated images and composites while the app runs
+    storage.start_reaper()
     # 确保所有必需的模板文件都存在
     # 在 PyInstaller 环境中，文件会被解压到临时目录，所以不需要预先检查
     if not getattr(sys, 'frozen', False):
@@ -140,4 +320,5 @@ if __name__ == '__main__':
                 sys.exit(1)
 
     Timer(1, open_browser).start()
-    app.run(debug=False, port=5001, host='127.0.0.1')
+    # Set [server] host = 0.0.0.0 so phones on the LAN can open local share links
+    app.run(debug=False, port=5001, host=config.get_setting('server', 'host'))
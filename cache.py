@@ -0,0 +1,163 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future
+
+
+# Punctuation that is part of names such as C# rather than sentence structure
+KEPT_PUNCTUATION = frozenset('#%&*@')
+
+
+def normalize_dream(dream):
+    """
+    Folds a dream description so that trivially different inputs share a key:
+    full-width/half-width forms are unified (NFKC), case is ignored and all
+    whitespace and punctuation is dropped, so "当医生！" and "当 医生" match.
+    Symbols and the punctuation in KEPT_PUNCTUATION are kept, since they can
+    change the dream: "成为C++工程师" and "成为C#工程师" are different dreams.
+    """
+    dream = unicodedata.normalize('NFKC', dream or '').lower()
+    return ''.join(ch for ch in dream
+                   if not ch.isspace()
+                   and (ch in KEPT_PUNCTUATION or not unicodedata.category(ch).startswith('P')))
+
+
+def make_key(*parts):
+    """Returns a hex digest identifying the given string/bytes parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Callers that ask for a key
+    while its call is in progress wait for it and share its result or
+    exception.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._calls[key] = future
+        if not owner:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def in_progress(self, key):
+        with self._lock:
+            return key in self._calls
+
+
+class DiskCache:
+    """
+    A small JSON cache with one file per entry.
+
+    Entries expire ttl seconds after they were written. Reading an entry
+    refreshes its modification time, and once there are more than
+    max_entries files the least recently used ones are deleted.
+    """
+
+    def __init__(self, directory, max_entries, ttl):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        with self._lock:
+            try:
+                with open(path, 'r', encoding='utf-8') as entry_file:
+                    entry = json.load(entry_file)
+            except (OSError, ValueError):
+                return None
+
+            if time.time() - entry.get('created', 0) > self.ttl:
+                self._remove(path)
+                return None
+
+            os.utime(path)
+            return entry.get('value')
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            with open(tmp_path, 'w', encoding='utf-8') as entry_file:
+                json.dump({'created': time.time(), 'value': value}, entry_file, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(self._path(key))
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        # Caller must hold self._lock
+        entries = []
+        now = time.time()
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.json'):
+                    continue
+                mtime = entry.stat().st_mtime
+                # mtime is refreshed on reads, so this only drops entries that
+                # are both old and unused; get() enforces the exact TTL.
+                if now - mtime > self.ttl:
+                    self._remove(entry.path)
+                else:
+                    entries.append((mtime, entry.path))
+
+        if len(entries) > self.max_entries:
+            entries.sort()
+            for _, path in entries[:len(entries) - self.max_entries]:
+                self._remove(path)
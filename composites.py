@@ -0,0 +1,279 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Composite images shared by /share and /download_composite.
+
+A composite is identified by a hash of (image_filename, text, name) and
+stored under a name derived from that hash, so downloading and then sharing
+the same dream renders it once. The cache is the files themselves: a hit
+costs one utime, which also keeps the least recently used composites first
+in line for eviction. Concurrent requests for the same composite wait for
+the render already in progress instead of starting their own.
+
+Rendering is CPU-bound Python and Pillow code that holds the GIL, so it runs
+in a pool of [composite] workers processes. Only filenames cross the process
+boundary: the worker reads the generated image from storage, usually still
+in the OS page cache, and writes the composite there itself.
+
+Run this module with a composite image to compare the output formats:
+
+    python composites.py composite_xxx.jpg
+"""
+
+import argparse
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cache
+import config
+import fonts
+import imaging
+import share
+import storage
+
+
+# Bump when the composite layout changes so old renders are not served
+LAYOUT_VERSION = "2"
+
+_renders = cache.SingleFlight()
+
+# Speculative renders wait here for a worker slot without tying up request threads
+_speculation_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='composite-speculate')
+
+_render_pool = None
+_render_slots = None
+_render_pool_lock = threading.Lock()
+
+
+class RenderBusyError(Exception):
+    """Raised when [composite] max_queued renders are already waiting for a worker."""
+
+
+class _SpeculationBusyError(RenderBusyError):
+    """A speculative render was refused to keep worker slots free for users."""
+
+
+class _RenderSlots:
+    """
+    Counts the renders that are running or waiting for a worker. Unlike a
+    semaphore it can refuse a render while some slots are still free, which
+    keeps those free for users.
+    """
+
+    def __init__(self, slots):
+        self._free = slots
+        self._lock = threading.Lock()
+
+    def take(self, reserve=0):
+        """Takes a slot if more than reserve slots are free."""
+        with self._lock:
+            if self._free <= reserve:
+                return False
+            self._free -= 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._free += 1
+
+
+def _init_worker():
+    # Each worker parses the fonts once instead of on its first render
+    fonts.preload()
+
+
+def get_render_pool():
+    """
+    Returns the process pool for rendering, or None to render in the calling
+    thread when [composite] workers is 0.
+    """
+    global _render_pool, _render_slots
+    workers = config.get_int_setting('composite', 'workers')
+    if workers <= 0:
+        return None
+    with _render_pool_lock:
+        if _render_pool is None:
+            # spawn instead of fork: forking a process that already runs
+            # request threads can copy locks held by those threads.
+            _render_pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+            )
+            _render_slots = _RenderSlots(workers + config.get_int_setting('composite', 'max_queued'))
+        return _render_pool
+
+
+def _reset_render_pool(pool):
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is pool:
+            _render_pool = None
+    pool.shutdown(wait=False)
+
+
+def render(image_filename, text, name, composite_filename=None, speculative=False):
+    """
+    Renders a composite in the worker pool and returns its filename. Raises
+    RenderBusyError if too many renders are queued, and TimeoutError if the
+    render takes longer than [composite] render_timeout seconds. Speculative
+    renders are refused unless more than [composite] workers slots are free,
+    so that many of them are always left for users' clicks.
+    """
+    pool = get_render_pool()
+    if pool is None:
+        return share.create_composite_image(image_filename, text, name, composite_filename=composite_filename)
+
+    slots = _render_slots
+    reserve = config.get_int_setting('composite', 'workers') if speculative else 0
+    if not slots.take(reserve):
+        error = _SpeculationBusyError if speculative else RenderBusyError
+        raise error("too many composites are being rendered")
+    try:
+        future = pool.submit(share.create_composite_image, image_filename, text, name,
+                             composite_filename=composite_filename)
+    except BaseException:
+        slots.release()
+        raise
+    # The slot stays taken until the worker is really done, even after a timeout
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=config.get_int_setting('composite', 'render_timeout'))
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory); start a fresh pool next time
+        _reset_render_pool(pool)
+        raise
+
+
+def normalize_text(text):
+    """
+    The plan text as the page and the generator may differ in it: line
+    endings and surrounding whitespace, neither of which shows in the composite.
+    """
+    return text.replace('\r\n', '\n').strip()
+
+
+def composite_key(image_filename, text, name):
+    # The format is part of the key so changing [composite] settings re-renders
+    return cache.make_key('composite', LAYOUT_VERSION, imaging.composite_format()[0],
+                          config.get_setting('composite', 'quality'),
+                          config.get_setting('composite', 'png_compress_level'),
+                          image_filename, normalize_text(text), name.strip())
+
+
+def _filename(key):
+    return f"composite_{key[:32]}{imaging.composite_format()[1]}"
+
+
+def _lookup(key):
+    """Returns the cached composite's filename, or None if it has to be rendered."""
+    filename = _filename(key)
+    try:
+        # The file's mtime is the on-disk LRU order
+        os.utime(storage.path(filename))
+    except FileNotFoundError:
+        return None
+    return filename
+
+
+def _evict():
+    """Deletes the least recently used composites beyond [cache] composite_max_entries."""
+    max_entries = config.get_int_setting('cache', 'composite_max_entries')
+    entries = list(storage.files('composites'))
+    if len(entries) <= max_entries:
+        return
+    entries.sort(key=lambda stored: stored.mtime)
+    for stored in entries[:len(entries) - max_entries]:
+        storage.remove(stored.filename)
+
+
+def get_composite(image_filename, text, name, speculative=False):
+    """
+    Returns the filename of the composite for this dream, rendering it only
+    if it isn't cached yet. Returns None if the generated image is missing.
+    """
+    # The same text must map to the same composite whether it comes from
+    # the speculative render or from the page
+    text, name = normalize_text(text), name.strip()
+    if not config.get_bool_setting('cache', 'composites'):
+        return render(image_filename, text, name, speculative=speculative)
+
+    key = composite_key(image_filename, text, name)
+    filename = _lookup(key)
+    if filename:
+        return filename
+
+    def render_once():
+        # A render that finished between the lookup above and this call
+        filename = _lookup(key)
+        if not filename:
+            filename = render(image_filename, text, name, composite_filename=_filename(key),
+                              speculative=speculative)
+            if filename:
+                _evict()
+        return filename
+
+    try:
+        return _renders.do(key, render_once)
+    except _SpeculationBusyError:
+        if speculative:
+            raise
+        # Joined a pre-render that was refused for lack of slots this request may use
+        return _renders.do(key, render_once)
+
+
+def _speculate(image_filename, text, name, preshare):
+    try:
+        filename = get_composite(image_filename, text, name, speculative=True)
+        if filename and preshare and not share.is_local_backend():
+            share.get_nextcloud_link(filename)
+    except RenderBusyError:
+        # The click renders it once the workers have time
+        print("渲染队列繁忙，跳过预先生成分享图")
+    except Exception as e:
+        # Nothing is lost; the user's click will simply do the work again
+        print(f"预先生成分享图失败: {e}")
+
+
+def speculate(image_filename, text, name):
+    """
+    Starts rendering the composite in the background as soon as a dream is
+    generated, so a later /share or /download_composite finds it finished or
+    joins the render in progress. With [share] preshare it is also uploaded
+    to Nextcloud and shared ahead of time; local links need no such step.
+    """
+    # Without the composite cache a click could never find the result
+    if not (config.get_bool_setting('share', 'prerender') and config.get_bool_setting('cache', 'composites')):
+        return
+    _speculation_executor.submit(_speculate, image_filename, text, name,
+                                 config.get_bool_setting('share', 'preshare'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare encoded size and time of composite formats.")
+    parser.add_argument('image', help="a composite image to re-encode, as a path or a composite filename")
+    args = parser.parse_args()
+
+    from PIL import Image
+    image_path = args.image if os.path.exists(args.image) else storage.path(args.image)
+    with Image.open(image_path) as image:
+        image = image.convert('RGB')
+    print(f"{args.image}: {image.width}x{image.height}")
+    for output_format, size, milliseconds in imaging.compare_composite_codecs(image):
+        print(f"{output_format:>5}  {size / 1024:8.0f} KB  {milliseconds:7.0f} ms")
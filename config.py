@@ -17,17 +17,104 @@ import configparser
 import os
 import sys
 
+from dotenv import load_dotenv
+
 CONFIG_FILE = 'config.ini'
 
-def get_config_path():
+# Defaults for the optional tuning sections. Older config.ini files may not
+# contain these sections, so every lookup falls back to the values below.
+DEFAULT_SETTINGS = {
+    'server': {
+        'max_workers': '4',
+        'max_queued_jobs': '32',
+        'job_ttl': '3600',
+        'host': '127.0.0.1',
+    },
+    'upload': {
+        'format': 'jpeg',
+        'quality': '85',
+        'max_bytes': '1048576',
+        'google_max_edge': '1536',
+        'qwen_max_edge': '2048',
+        'doubao_max_edge': '2048',
+    },
+    'router': {
+        'window': '50',
+        'attempt_timeout': '150',
+        'max_consecutive_failures': '3',
+        'cooldown': '60',
+    },
+    'limits': {
+        'max_wait': '20',
+        'google_rpm': '10',
+        'google_concurrency': '2',
+        'qwen_rpm': '60',
+        'qwen_concurrency': '4',
+        'doubao_rpm': '60',
+        'doubao_concurrency': '4',
+    },
+    'retry': {
+        'request_deadline': '180',
+        'max_attempts': '3',
+        'base_delay_ms': '500',
+        'max_delay_ms': '8000',
+    },
+    'composite': {
+        'format': 'jpeg',
+        'quality': '90',
+        'png_compress_level': '3',
+        'webp_method': '4',
+        'workers': '2',
+        'max_queued': '8',
+        'render_timeout': '60',
+    },
+    'share': {
+        'backend': 'nextcloud',
+        'public_base_url': '',
+        'link_ttl': '86400',
+        'qr_format': 'png',
+        'qr_cache_entries': '256',
+        'prerender': 'true',
+        'preshare': 'false',
+        'chunk_size': '5242880',
+        'upload_workers': '4',
+    },
+    'cache': {
+        'results': 'true',
+        'result_max_entries': '1000',
+        'result_ttl': '86400',
+        'plans': 'true',
+        'plan_max_entries': '5000',
+        'plan_ttl': '2592000',
+        'composites': 'true',
+        'image_store_mb': '256',
+        'composite_max_entries': '500',
+        'top_dreams': '成为一名宇航员, 当医生, 成为一名老师, 成为一名科学家, 成为一名畅销书作家',
+    },
+    'storage': {
+        'reap_interval': '600',
+        'tmp_max_age': '3600',
+        'photos_max_age': '86400',
+        'photos_max_mb': '1024',
+        'generated_max_age': '604800',
+        'generated_max_mb': '2048',
+        'composites_max_age': '604800',
+        'composites_max_mb': '1024',
+        'qr_max_age': '86400',
+        'qr_max_mb': '64',
+    },
+}
+
+def get_data_dir():
     # Get the directory of the executable
     if getattr(sys, 'frozen', False):
         # The application is frozen
-        datadir = os.path.dirname(sys.executable)
-    else:
-        # The application is not frozen
-        datadir = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(datadir, CONFIG_FILE)
+        return os.path.dirname(sys.executable)
+    # The application is not frozen
+    return os.path.dirname(os.path.abspath(__file__))
+
+def get_config_path():
+    return os.path.join(get_data_dir(), CONFIG_FILE)
 
 def init_config():
     """
@@ -41,6 +128,8 @@ def init_config():
             'qwen': '',
             'doubao': ''
         }
+        for section, values in DEFAULT_SETTINGS.items():
+            config[section] = values
         with open(config_path, 'w', encoding='utf-8') as configfile:
             config.write(configfile)
         print(f"Configuration file created at {config_path}. Please fill in your API keys.")
@@ -57,6 +146,38 @@ def get_api_key(service_name):
     config.read(config_path, encoding='utf-8')
     return config.get('api_keys', service_name, fallback=None)
 
+def get_setting(section, option):
+    """
+    Reads a setting from the configuration file, falling back to DEFAULT_SETTINGS.
+    """
+    fallback = DEFAULT_SETTINGS.get(section, {}).get(option)
+    config_path = get_config_path()
+    if not os.path.exists(config_path):
+        return fallback
+
+    config = configparser.ConfigParser()
+    config.read(config_path, encoding='utf-8')
+    return config.get(section, option, fallback=fallback)
+
+def get_int_setting(section, option):
+    """
+    Reads an integer setting; invalid values fall back to the default.
+    """
+    value = get_setting(section, option)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return int(DEFAULT_SETTINGS[section][option])
+
+def get_bool_setting(section, option):
+    """
+    Reads a boolean setting (true/false, yes/no, on/off, 1/0).
+    """
+    value = str(get_setting(section, option)).strip().lower()
+    if value in configparser.ConfigParser.BOOLEAN_STATES:
+        return configparser.ConfigParser.BOOLEAN_STATES[value]
+    return configparser.ConfigParser.BOOLEAN_STATES[DEFAULT_SETTINGS[section][option]]
+
 def get_available_services():
     """
     Returns a list of services that have an API key.
@@ -75,9 +196,14 @@ def get_available_services():
                 available_services.append(service)
     return available_services
 
-# For developer-specific settings that are not user-configurable
+# For developer-specific settings that are not user-configurable; they are
+# read from the environment or a .env file
+load_dotenv()
+
 DEV_CONFIG = {
     "WEBDAV_URL": os.getenv("WEBDAV_URL"),
     "APP_USERNAME": os.getenv("APP_USERNAME"),
-    "APP_PASSWORD": os.getenv("APP_PASSWORD")
+    "APP_PASSWORD": os.getenv("APP_PASSWORD"),
+    # Signs local share links; generated and kept in share_secret if unset
+    "SHARE_SECRET": os.getenv("SHARE_SECRET"),
 }
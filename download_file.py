@@ -13,45 +13,114 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import requests
+import itertools
+import mimetypes
 import os
+import requests
 import uuid
+from io import BytesIO
+from PIL import Image
 from urllib.parse import urlparse
+from imagestore import get_store
+import storage
+from providers import http_session
+from retry import Deadline, DeadlineExceeded, call_with_retry
+
+# Seconds to wait for the CDN to accept the connection
+CONNECT_TIMEOUT = 10
+
+def image_extension(mime_type, head=None, default=".png"):
+    """
+    Returns the file extension for an image MIME type such as "image/jpeg",
+    ignoring parameters like "; charset=binary". Anything else, such as a
+    CDN's application/octet-stream, says nothing about the image, so the
+    format is then detected from head, the first bytes of the file.
+    """
+    mime_type = (mime_type or "").split(";")[0].strip().lower()
+    if not mime_type.startswith("image/") and head:
+        try:
+            with Image.open(BytesIO(head)) as image:
+                mime_type = Image.MIME.get(image.format, "")
+        except OSError:
+            mime_type = ""
+    if not mime_type.startswith("image/"):
+        return default
+    return mimetypes.guess_extension(mime_type) or default
+
+def save_image_bytes(data, mime_type):
+    """
+    Writes encoded image bytes as they are, without decoding and re-encoding
+    them, and returns the generated filename.
+    """
+    filename = "generated_image_{}{}".format(uuid.uuid4(), image_extension(mime_type, data))
+    with open(storage.new_path(filename), 'wb') as file:
+        file.write(data)
+    # Hand the bytes to the composite step so it doesn't have to read them back;
+    # a no-op unless it renders in this process
+    get_store().put_bytes(filename, data)
+    return filename
 
-def download_file(url, save_directory="uploads"):
+def download_file(url, deadline=None):
     """
-    Download a file from a URL and save it locally
+    Download a file from a URL and save it to storage
     
     Args:
         url (str): The URL of the file to download
-        save_directory (str): Directory to save the file (default: "downloads")
+        deadline (Deadline): Time budget for the download including retries
     
     Returns:
-        str: Path to the downloaded file or None if download failed
+        str: Filename of the downloaded file or None if download failed
+
+    Raises:
+        DeadlineExceeded: if the deadline ran out, so the job fails with that error
     """
     try:
-        # Create the save directory if it doesn't exist
-        os.makedirs(save_directory, exist_ok=True)
-        
-        # Get the filename with a random one
-        filename = "generated_image_{}.png".format(uuid.uuid4())
-        
-        # Full path to save the file
-        file_path = os.path.join(save_directory, filename)
-        
         # Download the file
         print(f"Downloading file from: {url}")
-        response = requests.get(url, stream=True)
-        response.raise_for_status()  # Raise an exception for bad status codes
-        
-        # Save the file
-        with open(file_path, 'wb') as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
+        deadline = deadline or Deadline.default()
+
+        def attempt(timeout):
+            response = http_session().get(url, stream=True, timeout=(min(CONNECT_TIMEOUT, timeout), timeout))
+            # The with-block releases the connection back to the pool, also
+            # when the status is an error that gets retried
+            with response:
+                response.raise_for_status()  # Raise an exception for bad status codes
+
+                # Get the filename with a random one, keeping the format the provider sent
+                chunks = response.iter_content(chunk_size=8192)
+                head = next(chunks, b"")
+                filename = "generated_image_{}{}".format(uuid.uuid4(),
+                                                         image_extension(response.headers.get('Content-Type'), head))
+
+                # Save the file, keeping a copy only if this process renders composites.
+                # Write under a temporary name so a download that breaks off
+                # half-way never shows up as a generated image.
+                store = get_store()
+                data = bytearray() if store.enabled else None
+                file_path = storage.new_path(filename)
+                tmp_file_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+                try:
+                    with open(tmp_file_path, 'wb') as file:
+                        for chunk in itertools.chain([head], chunks):
+                            deadline.check()
+                            file.write(chunk)
+                            if data is not None:
+                                data += chunk
+                    os.replace(tmp_file_path, file_path)
+                except BaseException:
+                    os.remove(tmp_file_path)
+                    raise
+            if data is not None:
+                store.put_bytes(filename, data)
+            return filename
+
+        filename = call_with_retry(attempt, deadline, "Image download")
         
-        print(f"File downloaded successfully: {file_path}")
+        print(f"File downloaded successfully: {filename}")
         return filename
         
+    except DeadlineExceeded:
+        raise
     except requests.exceptions.RequestException as e:
         print(f"Error downloading file: {e}")
         return None
@@ -0,0 +1,79 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import threading
+
+from PIL import ImageFont
+
+FONT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "kaiti.ttf"))
+
+# Body, h3, h2 and h1 sizes of the composite image plus the largest title size
+PRELOAD_SIZES = (30, 32, 35, 40, 50)
+
+# (path, size) -> font; kaiti.ttf is a multi-megabyte CJK font, so each size
+# is parsed once per process and shared by all requests.
+_fonts = {}
+_fonts_lock = threading.Lock()
+_warned_missing = False
+
+
+def get_font(size, path=FONT_PATH):
+    """
+    Returns the font at `path` in the given size, or Pillow's default font if
+    it can't be loaded.
+    """
+    global _warned_missing
+    key = (path, size)
+    font = _fonts.get(key)
+    if font is not None:
+        return font
+
+    with _fonts_lock:
+        font = _fonts.get(key)
+        if font is None:
+            try:
+                font = ImageFont.truetype(path, size)
+            except IOError:
+                if not _warned_missing:
+                    print(f"警告: 未找到 {os.path.basename(path)} 字体。将使用默认字体。")
+                    _warned_missing = True
+                font = ImageFont.load_default()
+            _fonts[key] = font
+        return font
+
+
+def preload(sizes=PRELOAD_SIZES):
+    """Loads the sizes used by every composite so the first /share doesn't pay for it."""
+    for size in sizes:
+        get_font(size)
+
+
+def largest_fitting_size(sizes, fits):
+    """
+    Returns the largest of `sizes` (sorted ascending) for which fits(font)
+    is true, or the smallest size if none fits. Text only grows with the font
+    size, so this is a binary search that loads a handful of sizes at most.
+    """
+    low, high = 0, len(sizes) - 1
+    best = 0
+    while low <= high:
+        middle = (low + high) // 2
+        if fits(get_font(sizes[middle])):
+            best = middle
+            low = middle + 1
+        else:
+            high = middle - 1
+    return sizes[best]
@@ -0,0 +1,157 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+In-process store of recently generated images, keyed by filename.
+
+Only the process that renders composites keeps a store, so the hand-off
+from generation to composite depends on [composite] workers:
+
+- With workers = 0 the app renders itself. generate.py hands over the
+  encoded bytes as it writes them to storage, so the first render skips the
+  disk read, and decoded pixels are kept for later renders.
+- With workers > 0 the app keeps nothing and doesn't buffer downloads for
+  it; images are never sent through the pool. Each worker reads the file,
+  usually from the OS page cache, and keeps the decoded pixels of the
+  images it has rendered.
+
+[cache] image_store_mb is the budget of all these processes together.
+Files in storage stay the source of truth: an entry is only used while its
+file still exists, so files deleted by the reaper in the app are not served
+from a worker's store either.
+"""
+
+import multiprocessing
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+import config
+import storage
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class _Entry:
+    def __init__(self, data=None, image=None):
+        self.data = data
+        self.image = image
+
+    @property
+    def size(self):
+        size = len(self.data) if self.data is not None else 0
+        if self.image is not None:
+            size += self.image.width * self.image.height * len(self.image.getbands())
+        return size
+
+
+class ImageStore:
+    """
+    An LRU of encoded and decoded images that holds at most max_bytes,
+    counting both the encoded bytes and the decoded pixels.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _store(self, filename, entry):
+        # Caller must hold self._lock
+        old = self._entries.pop(filename, None)
+        if old is not None:
+            self._bytes -= old.size
+        if entry.size > self.max_bytes:
+            return
+        self._entries[filename] = entry
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+
+    @property
+    def enabled(self):
+        """False in a process that doesn't render, where callers can skip buffering."""
+        return self.max_bytes > 0
+
+    def put_bytes(self, filename, data):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._store(filename, _Entry(data=bytes(data)))
+
+    def get_bytes(self, filename):
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return None
+            self._entries.move_to_end(filename)
+            return entry.data
+
+    def put_image(self, filename, image):
+        """Keeps the decoded pixels of a fully loaded image next to its bytes."""
+        with self._lock:
+            entry = self._entries.get(filename)
+            self._store(filename, _Entry(data=entry.data if entry else None, image=image))
+
+    def open(self, filename):
+        """
+        Returns (image, decoded) for a generated image. decoded is True for
+        pixels from the store, which callers must treat as read-only;
+        otherwise the image is opened lazily from the stored bytes or from
+        storage. Raises FileNotFoundError if the image is gone.
+        """
+        if not storage.exists(filename):
+            # Deleted, possibly by another process; drop what we still have
+            self.discard(filename)
+            raise FileNotFoundError(filename)
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None:
+                self._entries.move_to_end(filename)
+                if entry.image is not None:
+                    return entry.image, True
+                if entry.data is not None:
+                    return Image.open(BytesIO(entry.data)), False
+        return Image.open(storage.path(filename)), False
+
+    def discard(self, filename):
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+
+def _process_budget():
+    max_bytes = config.get_int_setting('cache', 'image_store_mb') * 1024 * 1024
+    workers = config.get_int_setting('composite', 'workers')
+    if workers <= 0:
+        return max_bytes
+    if multiprocessing.parent_process() is None:
+        # The app; composites are rendered in the worker pool
+        return 0
+    return max_bytes // workers
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ImageStore(_process_budget())
+        return _store
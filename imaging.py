@@ -0,0 +1,158 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+import config
+
+# HEIC photos from iPhones need the optional pillow-heif plugin
+try:
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+except ImportError:
+    pass
+
+FORMATS = {
+    'jpeg': ('JPEG', '.jpg'),
+    'webp': ('WEBP', '.webp'),
+}
+
+COMPOSITE_FORMATS = {
+    'png': ('PNG', '.png'),
+    'jpeg': ('JPEG', '.jpg'),
+    'webp': ('WEBP', '.webp'),
+}
+
+MIN_QUALITY = 50
+
+# Shrink by whole factors (JPEG draft, then Image.reduce) only down to twice
+# the target size, so the final LANCZOS pass still has detail to work with.
+REDUCING_GAP = 2.0
+
+
+def _encode(image, pil_format, quality):
+    buffer = BytesIO()
+    if pil_format == 'JPEG':
+        image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffer, pil_format, quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def fast_resize(image, size):
+    """
+    Resizes a freshly opened image to `size` for the composite. JPEG sources
+    are decoded at a reduced scale, large shrinks start with a cheap integer
+    reduce(), and only images with transparency are converted to RGBA.
+    """
+    if image.format == 'JPEG':
+        image.draft('RGB', (int(size[0] * REDUCING_GAP), int(size[1] * REDUCING_GAP)))
+    mode = 'RGBA' if has_alpha(image) else 'RGB'
+    if image.mode != mode:
+        image = image.convert(mode)
+    return image.resize(size, Image.LANCZOS, reducing_gap=REDUCING_GAP)
+
+
+def composite_format():
+    """Returns (format name, extension) of composite images per [composite] format."""
+    output_format = config.get_setting('composite', 'format').lower()
+    if output_format not in COMPOSITE_FORMATS:
+        output_format = 'png'
+    return output_format, COMPOSITE_FORMATS[output_format][1]
+
+
+def encode_composite(image, output_format=None):
+    """
+    Encodes a composite image with the [composite] settings: PNG with
+    png_compress_level, progressive JPEG or WebP with quality. Returns the
+    encoded bytes.
+    """
+    output_format = output_format or composite_format()[0]
+    pil_format = COMPOSITE_FORMATS[output_format][0]
+    buffer = BytesIO()
+    if pil_format == 'PNG':
+        image.save(buffer, 'PNG', compress_level=config.get_int_setting('composite', 'png_compress_level'))
+    elif pil_format == 'JPEG':
+        image.save(buffer, 'JPEG', quality=config.get_int_setting('composite', 'quality'),
+                   optimize=True, progressive=True)
+    else:
+        image.save(buffer, 'WEBP', quality=config.get_int_setting('composite', 'quality'),
+                   method=config.get_int_setting('composite', 'webp_method'))
+    return buffer.getvalue()
+
+
+def compare_composite_codecs(image):
+    """
+    Encodes a composite with every supported format and returns
+    [(format, bytes, milliseconds)] so the settings can be compared.
+    """
+    results = []
+    for output_format in COMPOSITE_FORMATS:
+        started = time.perf_counter()
+        data = encode_composite(image, output_format)
+        results.append((output_format, len(data), (time.perf_counter() - started) * 1000))
+    return results
+
+
+def prepare_photo(image_path, service):
+    """
+    Prepares an uploaded photo for a provider: applies the EXIF orientation,
+    downscales it to the provider's max edge and recompresses it so that it
+    stays under [upload] max_bytes.
+
+    Returns the path of the prepared file, written next to the original. If
+    the photo can't be decoded, the original path is returned unchanged.
+    """
+    output_format = config.get_setting('upload', 'format').lower()
+    pil_format, extension = FORMATS.get(output_format, FORMATS['jpeg'])
+    quality = config.get_int_setting('upload', 'quality')
+    max_bytes = config.get_int_setting('upload', 'max_bytes')
+    max_edge = config.get_int_setting('upload', f'{service}_max_edge')
+
+    try:
+        with Image.open(image_path) as image:
+            # Let the JPEG decoder skip detail we are about to throw away
+            image.draft('RGB', (max_edge, max_edge))
+            image = ImageOps.exif_transpose(image)
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    except (OSError, ValueError) as e:
+        print(f"警告: 无法预处理图片 {image_path}: {e}，将使用原图。")
+        return image_path
+
+    data = _encode(image, pil_format, quality)
+    while len(data) > max_bytes and quality > MIN_QUALITY:
+        quality -= 10
+        data = _encode(image, pil_format, quality)
+
+    prepared_path = "{}_{}{}".format(os.path.splitext(image_path)[0], service, extension)
+    with open(prepared_path, 'wb') as prepared_file:
+        prepared_file.write(data)
+    print(f"Prepared {image_path} for {service}: {image.width}x{image.height}, {len(data)} bytes")
+    return prepared_path
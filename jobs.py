@@ -0,0 +1,211 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue already holds max_queued_jobs pending jobs."""
+
+
+class Job:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.retry_after = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.dedupe_key = None
+        # Partial results published while the job is running. version is
+        # bumped on every change so that listeners can wait for updates.
+        self.text_chunks = []
+        self.text_resets = 0
+        self.image_filename = None
+        self.version = 0
+        self._changed = threading.Condition()
+
+    def _update(self, **changes):
+        with self._changed:
+            for attr, value in changes.items():
+                setattr(self, attr, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    def append_text(self, delta):
+        if not delta:
+            return
+        with self._changed:
+            self.text_chunks.append(delta)
+            self.version += 1
+            self._changed.notify_all()
+
+    def reset_text(self):
+        """
+        Discards partial text and the image, e.g. when failing over to another
+        provider, so its plan is never shown next to the failed one's image.
+        """
+        with self._changed:
+            self.text_chunks = []
+            self.image_filename = None
+            self.text_resets += 1
+            self.version += 1
+            self._changed.notify_all()
+
+    def set_image(self, image_filename):
+        self._update(image_filename=image_filename)
+
+    def set_status(self, status):
+        self._update(status=status)
+
+    def wait_for_update(self, version_seen, timeout):
+        """
+        Blocks until the job has changed since version_seen or the timeout
+        expires. Returns a snapshot dict of the partial results.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version_seen, timeout=timeout)
+            return {
+                'version': self.version,
+                'text_chunks': list(self.text_chunks),
+                'text_resets': self.text_resets,
+                'image_filename': self.image_filename,
+                'status': self.status,
+            }
+
+    def to_dict(self):
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+        }
+        if self.status == DONE:
+            data.update(self.result)
+        elif self.status == FAILED:
+            data['error'] = self.error
+            if self.retry_after is not None:
+                data['retry_after'] = self.retry_after
+        return data
+
+
+class JobQueue:
+    """
+    A bounded worker pool for long-running generation jobs.
+
+    Jobs are kept in memory so that their status can be polled; finished jobs
+    are dropped once they are older than job_ttl seconds.
+    """
+
+    def __init__(self, max_workers, max_queued_jobs, job_ttl):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dream-job')
+        self._max_queued_jobs = max_queued_jobs
+        self._job_ttl = job_ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, name, fn, *args, dedupe_key=None, **kwargs):
+        """
+        Queues fn(job, *args, **kwargs) and returns the new Job immediately.
+
+        fn may publish partial results through the job it is given, and must
+        return a dict which becomes the job result, or raise. If a job with
+        the same dedupe_key is still queued or running, that job is returned
+        instead of starting another one.
+        """
+        with self._lock:
+            self._prune()
+            if dedupe_key is not None:
+                for job in self._jobs.values():
+                    if job.dedupe_key == dedupe_key and job.status in (QUEUED, RUNNING):
+                        return job
+            pending = sum(1 for job in self._jobs.values() if job.status in (QUEUED, RUNNING))
+            if pending >= self._max_queued_jobs:
+                raise QueueFullError(f"{pending} jobs already pending")
+            job = Job(name)
+            job.dedupe_key = dedupe_key
+            self._jobs[job.id] = job
+
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def complete(self, name, result):
+        """
+        Registers a job that is already done, e.g. for a cached result.
+        """
+        job = Job(name)
+        job.result = result
+        job.image_filename = result.get('image_filename')
+        job.finished_at = time.time()
+        job.status = DONE
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, fn, args, kwargs):
+        job.set_status(RUNNING)
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.finished_at = time.time()
+            job.set_status(DONE)
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job.error = str(e) or e.__class__.__name__
+            # Backpressure errors such as limits.ProviderBusyError say when to come back
+            job.retry_after = getattr(e, 'retry_after', None)
+            job.finished_at = time.time()
+            job.set_status(FAILED)
+
+    def _prune(self):
+        # Caller must hold self._lock
+        cutoff = time.time() - self._job_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """
+    Returns the process-wide job queue, creating it from config.ini on first use.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue(
+                max_workers=config.get_int_setting('server', 'max_workers'),
+                max_queued_jobs=config.get_int_setting('server', 'max_queued_jobs'),
+                job_ttl=config.get_int_setting('server', 'job_ttl'),
+            )
+        return _queue
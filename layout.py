@@ -0,0 +1,299 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Text layout for the composite share image.
+
+The markdown is parsed once into blocks and each block is split once into
+measured units (words, CJK characters and spaces). Lines are then broken
+from the cached widths for any text block width, and the final lines are
+replayed to draw them.
+"""
+
+import threading
+import weakref
+from collections import deque, namedtuple
+
+LIST_INDENT = 30
+BULLET_RADIUS = 4
+
+# Characters that may not start a line (closing brackets and punctuation)
+# and characters that may not end one (opening brackets and quotes).
+NO_LINE_START = set("，。、；：？！）」』】》〉〕］｝’”…‥·・ー～々ぁぃぅぇぉっゃゅょァィゥェォッャュョ,.;:!?)]}%％")
+NO_LINE_END = set("（「『【《〈〔［｛‘“([{")
+
+# kind is 'blank' or 'text'; font is a key into the fonts dict
+Block = namedtuple('Block', 'kind font indent is_list text')
+# A word, a single CJK character or a space; width is in pixels
+Unit = namedtuple('Unit', 'text bold width space')
+Run = namedtuple('Run', 'x text bold')
+Line = namedtuple('Line', 'y x font bullet runs')
+
+# font -> {character: advance}; fonts are cached per process (see fonts.py),
+# so every character is measured at most once per font.
+_advances = weakref.WeakKeyDictionary()
+_advances_lock = threading.Lock()
+
+
+def text_width(font, text):
+    if hasattr(font, 'getbbox'):
+        return font.getbbox(text)[2]
+    return font.getsize(text)[0]
+
+
+def char_advance(font, char):
+    table = _advances.get(font)
+    if table is None:
+        with _advances_lock:
+            table = _advances.setdefault(font, {})
+    advance = table.get(char)
+    if advance is None:
+        advance = font.getlength(char) if hasattr(font, 'getlength') else text_width(font, char)
+        table[char] = advance
+    return advance
+
+
+def is_cjk(char):
+    # CJK radicals and everything above (kana, hangul, ideographs, fullwidth
+    # forms, emoji) can be broken between any two characters.
+    return ord(char) >= 0x2E80
+
+
+def parse_markdown(text):
+    """
+    Splits the plan into blocks: blank lines, headings, list items and
+    paragraphs. Bold markers (**) are kept in the text and resolved per block.
+    """
+    blocks = []
+    for line in text.split('\n'):
+        line = line.strip()
+        if not line:
+            blocks.append(Block('blank', None, 0, False, ''))
+        elif line.startswith('### '):
+            blocks.append(Block('text', 'h3', 0, False, line[4:]))
+        elif line.startswith('## '):
+            blocks.append(Block('text', 'h2', 0, False, line[3:]))
+        elif line.startswith('# '):
+            blocks.append(Block('text', 'h1', 0, False, line[2:]))
+        elif line.startswith('* ') or line.startswith('- '):
+            blocks.append(Block('text', 'p', LIST_INDENT, True, line[2:]))
+        else:
+            blocks.append(Block('text', 'p', 0, False, line))
+    return blocks
+
+
+def split_units(text, font, bold_font):
+    """
+    Splits a block's text into measured units. Runs of Latin letters, digits
+    and ASCII punctuation stay together as words; CJK characters and spaces
+    are units of their own.
+    """
+    units = []
+    for segment_index, segment in enumerate(text.split('**')):
+        bold = segment_index % 2 == 1
+        segment_font = bold_font if bold else font
+        word = ''
+        for char in segment + ' ':
+            if char.isspace() or is_cjk(char):
+                if word:
+                    units.append(Unit(word, bold, sum(char_advance(segment_font, c) for c in word), False))
+                    word = ''
+                if char.isspace():
+                    units.append(Unit(' ', bold, char_advance(segment_font, ' '), True))
+                else:
+                    units.append(Unit(char, bold, char_advance(segment_font, char), False))
+            else:
+                word += char
+        units.pop()  # The sentinel space
+    return units
+
+
+def _split_word(unit, font, bold_font):
+    segment_font = bold_font if unit.bold else font
+    return [Unit(char, unit.bold, char_advance(segment_font, char), False) for char in unit.text]
+
+
+def _trim(line):
+    while line and line[-1].space:
+        line.pop()
+    return line
+
+
+def _kinsoku_carry(line, next_unit):
+    """
+    Returns the units to move from the end of `line` to the next line so that
+    the next line doesn't start with closing punctuation and this one
+    doesn't end with an opening bracket. Returns [] if there is no such break.
+    """
+    carried = []
+    first = next_unit
+    while len(line) > 1 and not line[-1].space and (
+            first.text[0] in NO_LINE_START or line[-1].text[-1] in NO_LINE_END):
+        first = line.pop()
+        carried.insert(0, first)
+    if len(line) == 1 and not line[-1].space and (
+            first.text[0] in NO_LINE_START or line[-1].text[-1] in NO_LINE_END):
+        # No acceptable break on this line; keep it as it was
+        line.extend(carried)
+        return []
+    return carried
+
+
+def break_lines(units, max_width, font, bold_font):
+    """
+    Greedily fills lines of at most max_width pixels from measured units,
+    breaking between CJK characters or at spaces and following the kinsoku
+    rules. Words wider than a whole line are split between characters.
+    """
+    lines = []
+    line = []
+    width = 0
+    pending = deque(units)
+    while pending:
+        unit = pending.popleft()
+        if unit.space and not line:
+            continue
+        if not unit.space and width + unit.width > max_width:
+            if _trim(line):
+                carried = _kinsoku_carry(line, unit)
+                lines.append(_trim(line))
+                line = carried
+                width = sum(u.width for u in line)
+                if line and width + unit.width > max_width:
+                    # The carried units and this one don't fit together; break before this one
+                    lines.append(line)
+                    line, width = [], 0
+            if not line and unit.width > max_width and len(unit.text) > 1:
+                pending.extendleft(reversed(_split_word(unit, font, bold_font)))
+                continue
+        line.append(unit)
+        width += unit.width
+    if _trim(line):
+        lines.append(line)
+    return lines
+
+
+class TextLayout:
+    """
+    Lays out parsed markdown blocks for any text block width. Units are
+    measured once per block; wrapping is cached per block and width and
+    re-used while the width is being solved.
+    """
+
+    def __init__(self, text, fonts, line_spacing):
+        self.blocks = parse_markdown(text)
+        self.fonts = fonts
+        self.line_spacing = line_spacing
+        self._units = {}
+        self._wrapped = {}
+
+    def _wrap(self, index, max_width):
+        block = self.blocks[index]
+        key = (index, max_width)
+        if key not in self._wrapped:
+            font = self.fonts[block.font]
+            if index not in self._units:
+                self._units[index] = split_units(block.text, font, self.fonts['b'])
+            self._wrapped[key] = break_lines(self._units[index], max_width - block.indent, font, self.fonts['b'])
+        return self._wrapped[key]
+
+    def height(self, max_width):
+        y = 0
+        for index, block in enumerate(self.blocks):
+            if block.kind == 'blank':
+                y += self.line_spacing
+                continue
+            line_height = self.fonts[block.font].size + self.line_spacing
+            y += line_height * len(self._wrap(index, max_width))
+        return y
+
+    def lines(self, max_width):
+        """
+        Returns the positioned lines for a width, relative to the top left
+        corner of the text block, with consecutive units of the same weight
+        merged into runs.
+        """
+        lines = []
+        y = 0
+        for index, block in enumerate(self.blocks):
+            if block.kind == 'blank':
+                y += self.line_spacing
+                continue
+            for i, units in enumerate(self._wrap(index, max_width)):
+                runs = []
+                x = block.indent
+                for unit in units:
+                    if runs and runs[-1].bold == unit.bold:
+                        runs[-1] = runs[-1]._replace(text=runs[-1].text + unit.text)
+                    else:
+                        runs.append(Run(x, unit.text, unit.bold))
+                    x += unit.width
+                lines.append(Line(y, block.indent, block.font, i == 0 and block.is_list, runs))
+                y += self.fonts[block.font].size + self.line_spacing
+        return lines
+
+    def draw(self, draw, lines, start_x, start_y, text_color, bold_text_color):
+        for line in lines:
+            font = self.fonts[line.font]
+            y = start_y + line.y
+            if line.bullet:
+                bullet_y = y + (font.size / 2) - BULLET_RADIUS
+                bullet_x = start_x + (line.x / 2) - BULLET_RADIUS
+                draw.ellipse(
+                    (bullet_x, bullet_y, bullet_x + BULLET_RADIUS * 2, bullet_y + BULLET_RADIUS * 2),
+                    fill=text_color
+                )
+            for run in line.runs:
+                draw.text((start_x + run.x, y), run.text, font=self.fonts['b'] if run.bold else font,
+                          fill=bold_text_color if run.bold else text_color)
+
+
+def solve_width(layout, image_size, padding, image_text_gap, max_iterations=16):
+    """
+    Finds the text block width at which the text, the photo scaled to the
+    text's height and the text block's 1.2x ratio to the photo agree.
+
+    Only the wrapped line counts change with the width, and each step only
+    re-breaks lines from cached glyph advances. Stops at the fixed point, or
+    at the widest width of a cycle when the line counts flip back and forth
+    between two widths.
+
+    Returns (text_block_width, text_height, image_width, image_height).
+    """
+    original_width, original_height = image_size
+
+    def dimensions(text_block_width):
+        text_height = layout.height(text_block_width)
+        image_height = text_height + padding * 2
+        if original_height > 0:
+            image_width = int(original_width * (image_height / original_height))
+        else:
+            image_width = original_width
+        return text_height, image_width, image_height
+
+    text_block_width = original_width  # Initial guess
+    seen = []
+    for _ in range(max_iterations):
+        seen.append(text_block_width)
+        _, image_width, _ = dimensions(text_block_width)
+        next_width = int(image_width * 1.2 - image_text_gap)
+        if next_width == text_block_width:
+            break
+        if next_width in seen:
+            text_block_width = max(seen[seen.index(next_width):])
+            break
+        text_block_width = next_width
+
+    return (text_block_width,) + dimensions(text_block_width)
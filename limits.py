@@ -0,0 +1,120 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+
+
+class ProviderBusyError(Exception):
+    """Raised when a provider call could not start within [limits] max_wait seconds."""
+
+    def __init__(self, service, retry_after):
+        super().__init__(f"{service} is busy, retry in {retry_after} s")
+        self.service = service
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per minute with bursts of up to `rate` calls.
+    """
+
+    def __init__(self, rate):
+        self.capacity = rate
+        self.tokens = float(rate)
+        self.fill_rate = rate / 60.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def acquire(self, timeout):
+        """
+        Takes one token, waiting up to timeout seconds. Returns 0 on success or
+        the number of seconds until a token would have been available.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return 0
+                wait = (1 - self.tokens) / self.fill_rate
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                return wait
+            time.sleep(wait)
+
+
+class ProviderLimiter:
+    """
+    A token bucket for requests per minute plus a semaphore for calls in flight.
+    A limit of 0 disables that part.
+    """
+
+    def __init__(self, service, rpm, concurrency):
+        self.service = service
+        self.bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.semaphore = threading.BoundedSemaphore(concurrency) if concurrency > 0 else None
+
+    @contextmanager
+    def slot(self, max_wait):
+        deadline = time.monotonic() + max_wait
+        if self.semaphore is not None and not self.semaphore.acquire(timeout=max_wait):
+            raise ProviderBusyError(self.service, math.ceil(max_wait))
+        try:
+            if self.bucket is not None:
+                wait = self.bucket.acquire(max(0, deadline - time.monotonic()))
+                if wait:
+                    raise ProviderBusyError(self.service, math.ceil(wait))
+            yield
+        finally:
+            if self.semaphore is not None:
+                self.semaphore.release()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(service):
+    with _limiters_lock:
+        if service not in _limiters:
+            _limiters[service] = ProviderLimiter(
+                service,
+                rpm=config.get_int_setting('limits', f'{service}_rpm'),
+                concurrency=config.get_int_setting('limits', f'{service}_concurrency'),
+            )
+        return _limiters[service]
+
+
+def slot(service, timeout=None):
+    """
+    Context manager that holds one call slot for a provider. Waits at most
+    [limits] max_wait seconds (or timeout, if that is shorter), then raises
+    ProviderBusyError.
+    """
+    max_wait = config.get_int_setting('limits', 'max_wait')
+    if timeout is not None:
+        max_wait = min(max_wait, timeout)
+    return get_limiter(service).slot(max_wait)
@@ -0,0 +1,89 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Expiring HMAC-signed links for the local share backend.
+
+A link is /s/<filename>?expires=<unix time>&sig=<hmac>, so it can be checked
+without any server-side state. The key comes from SHARE_SECRET in the
+environment, or is generated once and kept in share_secret next to
+config.ini so links survive a restart.
+"""
+
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from urllib.parse import quote
+
+import config
+from config import DEV_CONFIG
+
+SECRET_FILE = 'share_secret'
+EXPIRY_STEP = 600
+
+_secret = None
+_secret_lock = threading.Lock()
+
+
+def get_secret():
+    global _secret
+    with _secret_lock:
+        if _secret is None:
+            secret = DEV_CONFIG.get("SHARE_SECRET")
+            if not secret:
+                path = os.path.join(config.get_data_dir(), SECRET_FILE)
+                try:
+                    with open(path, 'r', encoding='utf-8') as secret_file:
+                        secret = secret_file.read().strip()
+                except FileNotFoundError:
+                    secret = None
+                if not secret:
+                    secret = secrets.token_hex(32)
+                    with open(path, 'w', encoding='utf-8') as secret_file:
+                        secret_file.write(secret)
+            _secret = secret.encode('utf-8')
+        return _secret
+
+
+def signature(filename, expires):
+    message = f"{filename}:{expires}".encode('utf-8')
+    return hmac.new(get_secret(), message, hashlib.sha256).hexdigest()
+
+
+def signed_url(base_url, filename, ttl):
+    """
+    Returns an absolute URL for filename that stops working after at least
+    ttl seconds. The expiry is rounded up to EXPIRY_STEP so repeated shares
+    of a composite get the same URL and hit the QR code cache.
+    """
+    expires = -(-(int(time.time()) + ttl) // EXPIRY_STEP) * EXPIRY_STEP
+    return f"{base_url.rstrip('/')}/s/{quote(filename)}?expires={expires}&sig={signature(filename, expires)}"
+
+
+def verify(filename, expires, sig):
+    """
+    Returns the seconds the link is still valid for, 0 if it has expired, or
+    None if the signature doesn't match.
+    """
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return None
+    if not sig or not hmac.compare_digest(signature(filename, expires), sig):
+        return None
+    return max(0, expires - int(time.time()))
@@ -0,0 +1,267 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import posixpath
+import threading
+import xml.etree.ElementTree as ET # 用于解析 XML 响应
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import cache
+import config
+import retry
+from config import DEV_CONFIG
+
+SERVER_URL = "https://gdzb.gx.cn"  # Nextcloud服务器的基础URL
+SHARE_API_PATH = "/ocs/v2.php/apps/files_sharing/api/v1/shares"
+
+# (connect, read) seconds
+TIMEOUT = (10, 120)
+
+DAV_NAMESPACE = '{DAV:}'
+
+_client = None
+_client_lock = threading.Lock()
+
+# Chunks of all uploads in flight share this pool
+_chunk_executor = ThreadPoolExecutor(
+    max_workers=config.get_int_setting('share', 'upload_workers'),
+    thread_name_prefix='nextcloud-chunk',
+)
+
+
+class NextcloudError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class NextcloudClient:
+    """
+    A WebDAV and OCS client for one Nextcloud account that is shared by all
+    threads. Connections are kept alive between shares, and directories that
+    are known to exist are not checked again, so a share is one PUT and one
+    POST. A 404 or 409 on upload means a directory disappeared on the server;
+    it is then created again and the upload retried once.
+
+    Files larger than [share] chunk_size are sent with Nextcloud's chunked
+    upload protocol: the chunks are PUT in parallel into an upload folder
+    and assembled with a MOVE. The upload folder is named after the file,
+    so a share that failed half-way resumes with the chunks still missing.
+    """
+
+    def __init__(self, webdav_url, username, password, server_url=SERVER_URL):
+        self.webdav_url = webdav_url.rstrip('/')
+        self.share_api_url = server_url.rstrip('/') + SHARE_API_PATH
+        # https://host/remote.php/dav/files/<user> -> https://host/remote.php/dav/uploads/<user>;
+        # the legacy /remote.php/webdav endpoint has no chunked uploads
+        if '/remote.php/dav/files/' in self.webdav_url:
+            self.uploads_url = self.webdav_url.replace('/remote.php/dav/files/', '/remote.php/dav/uploads/', 1)
+        else:
+            self.uploads_url = None
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._known_directories = set()
+        self._lock = threading.Lock()
+
+    def _url(self, remote_path):
+        return f"{self.webdav_url}/{quote(remote_path.strip('/'))}"
+
+    def ensure_directory(self, remote_directory):
+        remote_directory = remote_directory.strip('/')
+        if not remote_directory:
+            return
+        with self._lock:
+            if remote_directory in self._known_directories:
+                return
+
+        response = self.session.request('MKCOL', self._url(remote_directory) + '/', timeout=TIMEOUT)
+        if response.status_code == 409:
+            # The parent is missing as well
+            self.ensure_directory(posixpath.dirname(remote_directory))
+            response = self.session.request('MKCOL', self._url(remote_directory) + '/', timeout=TIMEOUT)
+        # 201: created, 405: it already exists
+        if response.status_code == 201:
+            print(f"远程目录 '{remote_directory}' 创建成功。")
+        elif response.status_code != 405:
+            raise NextcloudError(f"无法创建远程目录 '{remote_directory}'，状态码: {response.status_code}",
+                                 response.status_code)
+        with self._lock:
+            self._known_directories.add(remote_directory)
+
+    def forget_directory(self, remote_directory):
+        with self._lock:
+            # Its subdirectories are gone with it
+            self._known_directories = {
+                directory for directory in self._known_directories
+                if directory != remote_directory and not directory.startswith(remote_directory + '/')
+            }
+
+    def _put(self, local_path, remote_path):
+        with open(local_path, 'rb') as local_file:
+            return self.session.put(self._url(remote_path), data=local_file, timeout=TIMEOUT)
+
+    def _with_directory(self, remote_path, send):
+        """
+        Calls send() after making sure the parent directory exists, and once
+        more if the server answers that the directory is gone.
+        """
+        remote_directory = posixpath.dirname(remote_path.strip('/'))
+        self.ensure_directory(remote_directory)
+        response = send()
+        if response.status_code in (404, 409) and remote_directory:
+            print(f"远程目录 '{remote_directory}' 不存在，正在重新创建...")
+            self.forget_directory(remote_directory)
+            self.ensure_directory(remote_directory)
+            response = send()
+        return response
+
+    def upload(self, local_path, remote_path):
+        """Uploads a file, replacing any file with the same name."""
+        size = os.path.getsize(local_path)
+        chunk_size = config.get_int_setting('share', 'chunk_size')
+        if self.uploads_url and 0 < chunk_size < size:
+            return self._upload_chunked(local_path, remote_path, size, chunk_size)
+
+        response = self._with_directory(remote_path, lambda: self._put(local_path, remote_path))
+        if response.status_code not in (200, 201, 204):
+            raise NextcloudError(f"上传失败，状态码: {response.status_code}", response.status_code)
+
+    def _uploaded_chunks(self, upload_url, headers):
+        """
+        Creates the upload folder, or lists the chunks already in it from an
+        earlier attempt. Returns {chunk name: size}.
+        """
+        response = self.session.request('MKCOL', upload_url, headers=headers, timeout=TIMEOUT)
+        if response.status_code == 201:
+            return {}
+        if response.status_code != 405:
+            raise NextcloudError(f"无法创建上传目录，状态码: {response.status_code}", response.status_code)
+
+        response = self.session.request('PROPFIND', upload_url, headers={'Depth': '1'}, timeout=TIMEOUT)
+        if response.status_code != 207:
+            return {}
+        chunks = {}
+        for item in ET.fromstring(response.content).iter(f'{DAV_NAMESPACE}response'):
+            href = item.find(f'{DAV_NAMESPACE}href')
+            length = item.find(f'.//{DAV_NAMESPACE}getcontentlength')
+            if href is not None and length is not None and length.text:
+                chunks[posixpath.basename(unquote(urlparse(href.text).path).rstrip('/'))] = int(length.text)
+        return chunks
+
+    def _put_chunk(self, local_path, chunk_url, offset, length, headers):
+        with open(local_path, 'rb') as local_file:
+            local_file.seek(offset)
+            data = local_file.read(length)
+
+        def attempt(timeout):
+            response = self.session.put(chunk_url, data=data, headers=headers,
+                                        timeout=(min(TIMEOUT[0], timeout), timeout))
+            response.raise_for_status()
+
+        retry.call_with_retry(attempt, retry.Deadline.default(), "Chunk upload")
+
+    def _upload_chunked(self, local_path, remote_path, size, chunk_size):
+        stat = os.stat(local_path)
+        # The same file to the same path gets the same folder, so a retry resumes
+        upload_id = "dreamweaver-" + cache.make_key(remote_path, str(size), str(stat.st_mtime_ns))[:32]
+        upload_url = f"{self.uploads_url}/{upload_id}"
+        headers = {
+            'Destination': self._url(remote_path),
+            'OC-Total-Length': str(size),
+        }
+
+        uploaded = self._uploaded_chunks(upload_url, headers)
+        futures = []
+        for index, offset in enumerate(range(0, size, chunk_size), start=1):
+            name = f"{index:05d}"
+            length = min(chunk_size, size - offset)
+            if uploaded.get(name) == length:
+                continue
+            futures.append(_chunk_executor.submit(self._put_chunk, local_path, f"{upload_url}/{name}",
+                                                  offset, length, headers))
+        if uploaded:
+            print(f"继续上传 '{remote_path}'：还需上传 {len(futures)} 个分块")
+
+        # Wait for every chunk so the ones that made it are kept for the next attempt
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise NextcloudError(f"{len(errors)} 个分块上传失败: {errors[0]}")
+
+        response = self._with_directory(remote_path, lambda: self.session.request(
+            'MOVE', f"{upload_url}/.file", headers=headers, timeout=TIMEOUT))
+        if response.status_code not in (200, 201, 204):
+            raise NextcloudError(f"合并分块失败，状态码: {response.status_code}", response.status_code)
+
+    def create_public_share(self, remote_path):
+        """Creates a read-only public link share and returns its URL."""
+        headers = {
+            "OCS-APIRequest": "true",
+        }
+        data = {
+            "path": f"/{remote_path.strip('/')}",  # 注意路径前需要有斜杠
+            "shareType": 3,  # 3表示公开链接分享
+            "permissions": 1,  # 1表示只读权限
+        }
+        response = self.session.post(self.share_api_url, headers=headers, data=data, timeout=TIMEOUT)
+
+        # 检查响应状态
+        if response.status_code != 200:
+            print(f"响应内容: {response.text}")
+            raise NextcloudError(f"请求失败，状态码: {response.status_code}", response.status_code)
+
+        # --- 解析响应并提取分享链接 ---
+        root = ET.fromstring(response.content)
+        statuscode_element = root.find('meta/statuscode')
+        if statuscode_element is None:
+            print(f"收到的内容: {response.text}")
+            raise NextcloudError("在XML响应中未找到 'meta/statuscode' 元素。")
+
+        # Your server returns 200 for success in the XML, not 100
+        if statuscode_element.text != '200':
+            message = root.find('meta/message')
+            raise NextcloudError(f"创建分享链接失败: {message.text if message is not None else ''} "
+                                 f"(OCS 状态码: {statuscode_element.text})")
+
+        # The path to the URL is data -> url
+        url_element = root.find('data/url')
+        if url_element is None:
+            raise NextcloudError("API报告成功，但在XML中未找到 'data/url' 元素。")
+        return url_element.text
+
+
+def get_client():
+    """
+    Returns the shared client for the account in DEV_CONFIG, or None if
+    Nextcloud is not configured.
+    """
+    global _client
+    webdav_url = DEV_CONFIG.get("WEBDAV_URL")
+    username = DEV_CONFIG.get("APP_USERNAME")
+    app_password = DEV_CONFIG.get("APP_PASSWORD")
+    if not (webdav_url and username and app_password):
+        return None
+    with _client_lock:
+        if _client is None:
+            _client = NextcloudClient(webdav_url, username, app_password)
+        return _client
@@ -0,0 +1,118 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Photo-independent cache of action plans, keyed on the normalized dream text.
+
+Run this module to pre-generate plans for the dreams listed in
+[cache] top_dreams (or in a text file, one dream per line):
+
+    python plans.py --service qwen
+    python plans.py --service doubao --file top_dreams.txt --force
+"""
+
+import argparse
+import os
+import threading
+
+import cache
+import config
+
+_plan_cache = None
+_plan_cache_lock = threading.Lock()
+
+
+def get_plan_cache():
+    """
+    Returns the plan cache, or None if it is disabled in config.ini.
+    """
+    global _plan_cache
+    if not config.get_bool_setting('cache', 'plans'):
+        return None
+    with _plan_cache_lock:
+        if _plan_cache is None:
+            _plan_cache = cache.DiskCache(
+                os.path.join(config.get_data_dir(), 'plan_cache'),
+                max_entries=config.get_int_setting('cache', 'plan_max_entries'),
+                ttl=config.get_int_setting('cache', 'plan_ttl'),
+            )
+        return _plan_cache
+
+
+def _plan_key(dream):
+    normalized = cache.normalize_dream(dream)
+    return cache.make_key('plan', normalized) if normalized else None
+
+
+def get_cached_plan(dream):
+    plan_cache = get_plan_cache()
+    key = _plan_key(dream)
+    if plan_cache is None or key is None:
+        return None
+    entry = plan_cache.get(key)
+    return entry['plan'] if entry else None
+
+
+def store_plan(dream, plan):
+    plan_cache = get_plan_cache()
+    key = _plan_key(dream)
+    if plan_cache is None or key is None:
+        return
+    plan_cache.set(key, {'dream': dream, 'plan': plan})
+
+
+def get_top_dreams():
+    value = config.get_setting('cache', 'top_dreams') or ''
+    return [dream.strip() for dream in value.replace('，', ',').split(',') if dream.strip()]
+
+
+def pregenerate(dreams, service, force=False):
+    """
+    Generates and caches plans for the given dreams. Returns the number of
+    plans that were generated.
+    """
+    import generate
+
+    generated = 0
+    for dream in dreams:
+        if not force and get_cached_plan(dream):
+            print(f"已缓存，跳过: {dream}")
+            continue
+        print(f"正在生成: {dream}")
+        try:
+            plan = generate.PLAN_GENERATORS[service](dream)
+        except Exception as e:
+            print(f"生成失败: {dream}: {e}")
+            continue
+        store_plan(dream, plan)
+        generated += 1
+    return generated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-generate action plans for popular dreams.")
+    parser.add_argument('--service', choices=['qwen', 'doubao'], default='qwen')
+    parser.add_argument('--file', help="text file with one dream per line (default: [cache] top_dreams)")
+    parser.add_argument('--force', action='store_true', help="regenerate plans that are already cached")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'r', encoding='utf-8') as dreams_file:
+            dreams = [line.strip() for line in dreams_file if line.strip()]
+    else:
+        dreams = get_top_dreams()
+
+    count = pregenerate(dreams, args.service, force=args.force)
+    print(f"完成：生成了 {count} 条行动计划，共 {len(dreams)} 个梦想。")
@@ -0,0 +1,96 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import get_api_key
+
+DASHSCOPE_BASE_URL = 'https://dashscope.aliyuncs.com/api/v1'
+ARK_BASE_URL = 'https://ark.cn-beijing.volces.com/api/v3'
+
+# service name -> (api_key the client was built with, client)
+_clients = {}
+_clients_lock = threading.Lock()
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def _build_genai_client(api_key):
+    from google import genai
+    return genai.Client(api_key=api_key)
+
+
+def _build_ark_client(api_key):
+    # 通过 pip install 'volcengine-python-sdk[ark]' 安装方舟SDK
+    from volcenginesdkarkruntime import Ark
+    # Retries are handled by retry.call_with_retry within the request deadline
+    return Ark(base_url=ARK_BASE_URL, api_key=api_key, max_retries=0)
+
+
+def _build_dashscope_client(api_key):
+    # dashscope is used through module-level functions that take the key per
+    # call and already share one pooled session, so only the endpoint is set here.
+    import dashscope
+    dashscope.base_http_api_url = DASHSCOPE_BASE_URL
+    return dashscope
+
+
+_FACTORIES = {
+    'google': _build_genai_client,
+    'doubao': _build_ark_client,
+    'qwen': _build_dashscope_client,
+}
+
+
+def get_client(service):
+    """
+    Returns (api_key, client) for a service, or (None, None) if no key is configured.
+
+    Clients are created once per process and reused by all threads. A client
+    is rebuilt only when its API key in config.ini has changed.
+    """
+    api_key = get_api_key(service)
+    if not api_key:
+        return None, None
+
+    with _clients_lock:
+        cached = _clients.get(service)
+        if cached is not None and cached[0] == api_key:
+            return cached
+        client = _FACTORIES[service](api_key)
+        _clients[service] = (api_key, client)
+        return api_key, client
+
+
+def http_session():
+    """
+    Returns the shared requests session used for plain HTTP downloads.
+
+    requests.Session is safe to share between threads for simple requests, and
+    reusing it keeps connections to the provider CDNs alive between calls.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+        return _http_session
@@ -0,0 +1,129 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+import time
+
+import requests
+
+import config
+
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the time budget of a request has run out."""
+
+
+class ProviderError(RuntimeError):
+    """A provider answered with an error status instead of raising itself (e.g. dashscope)."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Deadline:
+    """
+    An end-to-end time budget. Stages take slices of what is left with
+    stage(), so a slow early stage can't starve the later ones of their share
+    and nothing runs past the overall deadline. A deadline also ends when its
+    parent does, so cancel() stops everything below it at the next check().
+    """
+
+    def __init__(self, seconds, parent=None):
+        self.expires = time.monotonic() + seconds
+        self.parent = parent
+
+    @classmethod
+    def default(cls):
+        return cls(config.get_int_setting('retry', 'request_deadline'))
+
+    def remaining(self):
+        remaining = max(0.0, self.expires - time.monotonic())
+        if self.parent is not None:
+            remaining = min(remaining, self.parent.remaining())
+        return remaining
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded("request deadline exceeded")
+
+    def stage(self, fraction):
+        """Returns a deadline for a stage that may use `fraction` of the remaining time."""
+        return Deadline(self.remaining() * fraction, parent=self)
+
+    def limit(self, seconds):
+        """Returns a deadline that ends after at most `seconds`, or with this one."""
+        return Deadline(min(seconds, self.remaining()), parent=self)
+
+    def cancel(self):
+        """Ends this deadline now, e.g. when the work holding it was abandoned."""
+        self.expires = time.monotonic()
+
+
+def is_transient(error):
+    """
+    True for errors worth retrying: connection resets, timeouts, 429 and 5xx.
+    """
+    # ChunkedEncodingError: the connection broke off in the middle of a streamed body
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                          ConnectionError, TimeoutError)):
+        return True
+    # Ark, google-genai and ProviderError expose the HTTP status in one of these
+    for attr in ('status_code', 'code'):
+        status = getattr(error, attr, None)
+        if isinstance(status, int):
+            return status in TRANSIENT_STATUS_CODES
+    response = getattr(error, 'response', None)
+    if response is not None and isinstance(getattr(response, 'status_code', None), int):
+        return response.status_code in TRANSIENT_STATUS_CODES
+    # Connection and timeout errors of the SDKs carry no status code
+    name = type(error).__name__
+    return 'Connection' in name or 'Timeout' in name
+
+
+def call_with_retry(fn, deadline, description="provider call", should_retry=None):
+    """
+    Calls fn(timeout) until it succeeds, retrying transient errors with
+    jittered exponential backoff. timeout is the number of seconds left in
+    the deadline and should be passed on to the underlying client.
+
+    Gives up with the last error after [retry] max_attempts attempts, and
+    raises DeadlineExceeded instead of sleeping past the deadline.
+    should_retry, if given, can veto a retry (e.g. once streaming output has
+    already reached the user).
+    """
+    max_attempts = config.get_int_setting('retry', 'max_attempts')
+    delay = config.get_int_setting('retry', 'base_delay_ms') / 1000
+    max_delay = config.get_int_setting('retry', 'max_delay_ms') / 1000
+
+    attempt = 1
+    while True:
+        deadline.check()
+        try:
+            return fn(deadline.remaining())
+        except Exception as e:
+            if attempt >= max_attempts or not is_transient(e) or (should_retry and not should_retry()):
+                raise
+            sleep = random.uniform(0, min(max_delay, delay * 2 ** (attempt - 1)))
+            if sleep >= deadline.remaining():
+                raise DeadlineExceeded(f"{description} failed and no time is left to retry: {e}") from e
+            print(f"{description} failed ({e}), retrying in {sleep:.1f}s ({attempt}/{max_attempts})")
+            time.sleep(sleep)
+            attempt += 1
@@ -0,0 +1,229 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import config
+import generate
+import limits
+import retry
+
+AUTO = 'auto'
+
+GENERATORS = {
+    'google': generate.generate_dream_image_and_plan,
+    'qwen': generate.generate_dream_image_and_plan_qwen,
+    'doubao': generate.generate_dream_image_and_plan_doubao,
+}
+
+# Older pages and scripts still send 'gemini'
+ALIASES = {
+    'gemini': 'google',
+}
+
+
+class ProviderTimeoutError(Exception):
+    """Raised when a provider did not answer within its attempt deadline."""
+
+
+class ProviderStats:
+    """
+    Rolling latency and error statistics for one provider.
+    """
+
+    def __init__(self, window):
+        self._samples = deque(maxlen=window)  # (latency in seconds, succeeded)
+        self._consecutive_failures = 0
+        self._cooldown_until = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency, succeeded):
+        with self._lock:
+            self._samples.append((latency, succeeded))
+            if succeeded:
+                self._consecutive_failures = 0
+            else:
+                self._consecutive_failures += 1
+                if self._consecutive_failures >= config.get_int_setting('router', 'max_consecutive_failures'):
+                    self._cooldown_until = time.time() + config.get_int_setting('router', 'cooldown')
+
+    def percentile(self, p):
+        with self._lock:
+            latencies = sorted(latency for latency, succeeded in self._samples if succeeded)
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))
+        return latencies[index]
+
+    def error_rate(self):
+        with self._lock:
+            if not self._samples:
+                return 0.0
+            return sum(1 for _, succeeded in self._samples if not succeeded) / len(self._samples)
+
+    def in_cooldown(self):
+        return time.time() < self._cooldown_until
+
+    def score(self):
+        """
+        Lower is better. Providers without samples score 0 so they get tried;
+        providers that only ever failed are scored as if they timed out.
+        """
+        p50 = self.percentile(50)
+        if p50 is None:
+            with self._lock:
+                has_samples = bool(self._samples)
+            p50 = config.get_int_setting('router', 'attempt_timeout') if has_samples else 0
+        return p50 * (1 + 4 * self.error_rate())
+
+    def to_dict(self):
+        with self._lock:
+            samples = len(self._samples)
+        return {
+            'samples': samples,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'error_rate': round(self.error_rate(), 3),
+            'cooldown': self.in_cooldown(),
+        }
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+# An abandoned attempt keeps its thread until it notices its cancelled
+# deadline, so with 'auto' every job may hold one thread per provider
+_attempt_executor = ThreadPoolExecutor(
+    max_workers=config.get_int_setting('server', 'max_workers') * len(GENERATORS),
+    thread_name_prefix='dream-attempt',
+)
+
+
+def get_stats(service):
+    with _stats_lock:
+        if service not in _stats:
+            _stats[service] = ProviderStats(config.get_int_setting('router', 'window'))
+        return _stats[service]
+
+
+def resolve(service):
+    """
+    Returns the canonical provider name, 'auto', or None if it is unknown.
+    """
+    service = ALIASES.get(service, service)
+    if service == AUTO or service in GENERATORS:
+        return service
+    return None
+
+
+def rank_providers():
+    """
+    Returns the configured providers, healthiest first. Providers in cooldown
+    after repeated failures go last but are still tried as a final resort.
+    """
+    services = [service for service in config.get_available_services() if service in GENERATORS]
+    return sorted(services, key=lambda service: (get_stats(service).in_cooldown(), get_stats(service).score()))
+
+
+def call_provider(service, dream, image_path, on_text=None, on_image=None, deadline=None):
+    """
+    Calls one provider, records its latency and outcome, and returns
+    (generated_text, image_filename). Raises if the provider failed or did not
+    answer within [router] attempt_timeout seconds or the request deadline.
+    Callbacks from an attempt that was abandoned after its deadline are ignored,
+    and its deadline is cancelled so it stops at its next check.
+    """
+    deadline = deadline or retry.Deadline.default()
+    attempt_deadline = deadline.limit(config.get_int_setting('router', 'attempt_timeout'))
+    active = threading.Event()
+    active.set()
+
+    def abandon():
+        active.clear()
+        attempt_deadline.cancel()
+
+    def guarded(callback):
+        if callback is None:
+            return None
+        return lambda value: callback(value) if active.is_set() else None
+
+    started = time.time()
+    future = _attempt_executor.submit(GENERATORS[service], dream, image_path,
+                                      on_text=guarded(on_text), on_image=guarded(on_image),
+                                      deadline=attempt_deadline)
+    try:
+        generated_text, image_filename = future.result(timeout=attempt_deadline.remaining())
+        if not (generated_text and image_filename):
+            raise RuntimeError(f"{service} returned no result: {generated_text}")
+    except FutureTimeoutError:
+        abandon()
+        get_stats(service).record(time.time() - started, False)
+        raise ProviderTimeoutError(f"{service} did not answer in time")
+    except limits.ProviderBusyError:
+        # Our own rate limit, not a sign of an unhealthy provider
+        abandon()
+        raise
+    except Exception:
+        abandon()
+        get_stats(service).record(time.time() - started, False)
+        raise
+
+    get_stats(service).record(time.time() - started, True)
+    return generated_text, image_filename
+
+
+def generate_dream(service, dream, image_path, on_text=None, on_image=None, on_reset=None, deadline=None):
+    """
+    Generates with the given provider, or with 'auto' tries the configured
+    providers from healthiest to least healthy until one succeeds or the
+    deadline runs out. on_reset is called before a failover so partial text
+    from the failed provider can be discarded.
+    """
+    deadline = deadline or retry.Deadline.default()
+    if service != AUTO:
+        return call_provider(service, dream, image_path, on_text=on_text, on_image=on_image, deadline=deadline)
+
+    candidates = rank_providers()
+    if not candidates:
+        raise RuntimeError("No API service configured")
+
+    last_error = None
+    busy_errors = []
+    for index, candidate in enumerate(candidates):
+        if deadline.expired():
+            break
+        if index > 0 and on_reset:
+            on_reset()
+        try:
+            print(f"Auto routing to {candidate}")
+            return call_provider(candidate, dream, image_path, on_text=on_text, on_image=on_image,
+                                 deadline=deadline)
+        except limits.ProviderBusyError as e:
+            print(f"Provider {candidate} is busy, trying the next one")
+            busy_errors.append(e)
+        except Exception as e:
+            print(f"Provider {candidate} failed, trying the next one: {e}")
+            last_error = e
+    if busy_errors:
+        # At least one provider is healthy but saturated; tell the caller when to retry
+        raise min(busy_errors, key=lambda e: e.retry_after)
+    raise last_error or retry.DeadlineExceeded("request deadline exceeded")
+
+
+def health():
+    return {service: get_stats(service).to_dict() for service in GENERATORS}
@@ -13,23 +13,40 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import base64
+import functools
+import threading
 import requests
-from urllib.parse import quote
-from webdav3.client import Client
 import qrcode
-import xml.etree.ElementTree as ET # 用于解析 XML 响应
+import qrcode.image.svg
 import os
-from config import DEV_CONFIG
-from PIL import Image, ImageDraw, ImageFont
-import textwrap
+import cache
+import config
+import links
+import nextcloud
+from PIL import Image, ImageDraw
+from fonts import get_font, largest_fitting_size
+import imagestore
+import storage
+import imaging
+import layout
+import time
 import uuid
+from collections import OrderedDict
+from io import BytesIO
 
-def create_composite_image(image_filename, text, name):
-    original_image_path = os.path.join("uploads", image_filename)
+# composite filename -> Nextcloud share link, most recently used last
+NEXTCLOUD_LINK_CACHE_ENTRIES = 1024
+_nextcloud_links = OrderedDict()
+_nextcloud_links_lock = threading.Lock()
+_nextcloud_shares = cache.SingleFlight()
+
+def create_composite_image(image_filename, text, name, composite_filename=None):
     try:
-        original_image = Image.open(original_image_path).convert("RGBA")
+        # Pixels are decoded once the target size is known, unless the store has them already
+        original_image, decoded = imagestore.get_store().open(image_filename)
     except FileNotFoundError:
-        print(f"错误：找不到图片文件 {original_image_path}")
+        print(f"错误：找不到图片文件 {image_filename}")
         return None
 
     # --- Configuration ---
@@ -43,147 +60,40 @@ def create_composite_image(image_filename, text, name):
     title_top_margin = 60
     title_bottom_margin = 40
 
-    # --- Font ---
-    try:
-        font_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "kaiti.ttf"))
-        font = ImageFont.truetype(font_path, font_size)
-        bold_font = ImageFont.truetype(font_path, font_size) # Re-using for simplicity
-        h1_font = ImageFont.truetype(font_path, font_size + 10)
-        h2_font = ImageFont.truetype(font_path, font_size + 5)
-        h3_font = ImageFont.truetype(font_path, font_size + 2)
-    except IOError:
-        print("警告: 未找到 kaiti.ttf 字体。将使用默认字体。")
-        font = ImageFont.load_default()
-        bold_font = ImageFont.load_default()
-        h1_font = ImageFont.load_default()
-        h2_font = ImageFont.load_default()
-        h3_font = ImageFont.load_default()
-
+    # --- Font (loaded once per process, see fonts.py) ---
     fonts = {
-        'p': font,
-        'b': bold_font,
-        'h1': h1_font,
-        'h2': h2_font,
-        'h3': h3_font,
+        'p': get_font(font_size),
+        'b': get_font(font_size),  # Re-using for simplicity
+        'h1': get_font(font_size + 10),
+        'h2': get_font(font_size + 5),
+        'h3': get_font(font_size + 2),
     }
 
-    # --- Helper function to render text and calculate height ---
-    def render_and_calculate_text_height(draw, text, start_x, start_y, max_width, render=False):
-        y = start_y
-        lines = text.split('\n')
-
-        for line in lines:
-            line = line.strip()
-            if not line:
-                y += line_spacing
-                continue
-
-            # Determine line type (heading, list, or paragraph)
-            current_font = fonts['p']
-            line_indent = 0
-            is_list_item = False
-
-            if line.startswith('### '):
-                current_font = fonts['h3']
-                line = line[4:]
-            elif line.startswith('## '):
-                current_font = fonts['h2']
-                line = line[3:]
-            elif line.startswith('# '):
-                current_font = fonts['h1']
-                line = line[2:]
-            elif line.startswith('* ') or line.startswith('- '):
-                is_list_item = True
-                line = line[2:]
-                line_indent = 30 # Indent for list items
-
-            # Wrap the line
-            avg_char_width = current_font.getbbox("一")[2] if hasattr(current_font, 'getbbox') else current_font.getsize("一")[0]
-            chars_per_line = max(1, int((max_width - line_indent) / avg_char_width))
-            wrapped_text = textwrap.wrap(line, width=chars_per_line, replace_whitespace=False)
-
-            # Render wrapped lines
-            for i, wrapped_line in enumerate(wrapped_text):
-                x = start_x + line_indent
-                if i == 0 and is_list_item:
-                    if render:
-                        bullet_radius = 4
-                        bullet_y = y + (current_font.size / 2) - bullet_radius
-                        bullet_x = start_x + (line_indent / 2) - bullet_radius
-                        draw.ellipse(
-                            (bullet_x, bullet_y, bullet_x + bullet_radius * 2, bullet_y + bullet_radius * 2),
-                            fill=text_color
-                        )
-                
-                # Handle bold text within the line
-                parts = wrapped_line.split('**')
-                is_bold = False
-                for part in parts:
-                    font_to_use = fonts['b'] if is_bold else current_font
-                    if render:
-                        draw.text((x, y), part, font=font_to_use, fill=bold_text_color if is_bold else text_color)
-                    
-                    if hasattr(font_to_use, 'getbbox'):
-                        part_width = font_to_use.getbbox(part)[2]
-                    else:
-                        part_width = font_to_use.getsize(part)[0]
-                    x += part_width
-                    is_bold = not is_bold
-
-                y += current_font.size + line_spacing
-
-        return y - start_y
-
-    # --- Iteratively determine layout ---
-    text_block_width = original_image.width  # Initial guess
-
-    for _ in range(3):  # Iterate 3 times to stabilize
-        dummy_draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
-        text_height_for_content = render_and_calculate_text_height(dummy_draw, text, 0, 0, text_block_width, render=False)
-        
-        image_height = text_height_for_content + padding * 2
-
-        if original_image.height > 0:
-            image_width = int(original_image.width * (image_height / original_image.height))
-        else:
-            image_width = original_image.width
-
-        text_block_width = int(image_width * 1.2 - image_text_gap)
-
-    # --- Final dimensions after iteration ---
-    dummy_draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
-    text_height = render_and_calculate_text_height(dummy_draw, text, 0, 0, text_block_width, render=False)
-    image_height = text_height + padding * 2
-    if original_image.height > 0:
-        image_width = int(original_image.width * (image_height / original_image.height))
-    else:
-        image_width = original_image.width
+    # --- Lay out the text once and solve for the block widths ---
+    text_layout = layout.TextLayout(text, fonts, line_spacing)
+    text_block_width, text_height, image_width, image_height = layout.solve_width(
+        text_layout, original_image.size, padding, image_text_gap)
+    text_lines = text_layout.lines(text_block_width)
     
-    resized_image = original_image.resize((image_width, int(image_height)), Image.LANCZOS)
+    resized_image = imaging.fast_resize(original_image, (image_width, int(image_height)))
+    if not decoded and original_image.format != 'JPEG':
+        # Fully decoded now; JPEGs are decoded at a reduced scale, which is cheaper than keeping them
+        imagestore.get_store().put_image(image_filename, original_image)
 
     # --- Calculate Title Size and adjust font to meet height constraint ---
     title_text = f"{name}，你的梦想一定可以实现，加油吧！"
-    title_font_size = font_size + 20
-    title_total_height = 0
-    title_height = 0
-
-    while title_font_size > 10:
-        try:
-            title_font = ImageFont.truetype(font_path, title_font_size)
-        except IOError:
-            title_font = ImageFont.load_default()
 
+    def title_fits(title_font):
         title_bbox = title_font.getbbox(title_text)
-        title_height = title_bbox[3] - title_bbox[1]
-        title_total_height = title_top_margin + title_height + title_bottom_margin
-        
-        if title_total_height <= image_height * 0.2 + padding:
-            break
-        
-        title_font_size -= 2
-    
+        return title_top_margin + (title_bbox[3] - title_bbox[1]) + title_bottom_margin <= image_height * 0.2 + padding
+
+    # Largest of font_size + 20, font_size + 18, ... 12 that fits
+    title_font_size = largest_fitting_size(range(12, font_size + 21, 2), title_fits)
+    title_font = get_font(title_font_size)
+
     title_bbox = title_font.getbbox(title_text)
     title_width = title_bbox[2] - title_bbox[0]
+    title_total_height = title_top_margin + (title_bbox[3] - title_bbox[1]) + title_bottom_margin
 
     # --- Create Composite Image ---
     final_width = image_width + text_block_width + image_text_gap + padding * 2
@@ -199,57 +109,132 @@ def create_composite_image(image_filename, text, name):
 
     # 2. Paste resized image
     image_y_offset = title_total_height
-    composite_image.paste(resized_image, (padding, image_y_offset), resized_image)
+    composite_image.paste(resized_image, (padding, image_y_offset),
+                          resized_image if resized_image.mode == 'RGBA' else None)
 
     # 3. Render text on the final image
     text_start_x = padding + image_width + image_text_gap
     text_start_y = image_y_offset + padding
-    render_and_calculate_text_height(final_draw, text, text_start_x, text_start_y, text_block_width, render=True)
+    text_layout.draw(final_draw, text_lines, text_start_x, text_start_y, text_color, bold_text_color)
 
     # --- Save new image ---
-    composite_filename = f"composite_{uuid.uuid4()}.png"
-    composite_filepath = os.path.join("uploads", composite_filename)
-    composite_image.save(composite_filepath)
+    output_format, extension = imaging.composite_format()
+    composite_filename = composite_filename or f"composite_{uuid.uuid4()}{extension}"
+    composite_filepath = storage.new_path(composite_filename)
+    started = time.perf_counter()
+    data = imaging.encode_composite(composite_image, output_format)
+    print(f"合成图编码完成: {composite_filename} {final_width}x{final_height} {output_format}, "
+          f"{len(data) // 1024} KB, {(time.perf_counter() - started) * 1000:.0f} ms")
+    # Write under a temporary name so a concurrent reader never sees a partial file
+    tmp_filepath = f"{composite_filepath}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_filepath, 'wb') as composite_file:
+        composite_file.write(data)
+    os.replace(tmp_filepath, composite_filepath)
 
     return composite_filename
 
-def share(filename):
-    load_dotenv()
+def share(filename, base_url=None):
+    """
+    Shares a composite and returns (share_url, QR code as a data URI), or
+    None if sharing failed. [share] backend selects where the link points
+    to: 'nextcloud' uploads the file and creates a public Nextcloud share,
+    'local' links to this app with an expiring signed URL.
+    """
+    if is_local_backend():
+        share_url = create_local_link(filename, base_url)
+    else:
+        share_url = get_nextcloud_link(filename)
+    if not share_url:
+        return None
+
+    return share_url, qr_data_uri(share_url, config.get_setting('share', 'qr_format').strip().lower())
 
-    # 1. 配置Nextcloud信息
-    webdav_url = DEV_CONFIG.get("WEBDAV_URL")
-    username = DEV_CONFIG.get("APP_USERNAME")
-    app_password = DEV_CONFIG.get("APP_PASSWORD")
+@functools.lru_cache(maxsize=config.get_int_setting('share', 'qr_cache_entries'))
+def qr_data_uri(share_url, qr_format='png'):
+    """
+    Renders the QR code for a link in memory and returns it as a data URI
+    that the page can show directly, as a 1-bit PNG or as an SVG path.
+    """
+    # 生成二维码
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(share_url)
+    qr.make(fit=True)
+
+    buffer = BytesIO()
+    if qr_format == 'svg':
+        qr.make_image(image_factory=qrcode.image.svg.SvgPathImage).save(buffer)
+        mime_type = 'image/svg+xml'
+    else:
+        img = qr.make_image(fill_color="black", back_color="white")
+        img.save(buffer, format='PNG', optimize=True)
+        mime_type = 'image/png'
+    return f"data:{mime_type};base64,{base64.b64encode(buffer.getvalue()).decode('ascii')}"
+
+def is_local_backend():
+    return config.get_setting('share', 'backend').strip().lower() == 'local'
+
+def get_nextcloud_link(filename):
+    """
+    Returns the Nextcloud share link of a composite, uploading and sharing
+    it only the first time. Composite names are content hashes, so a link
+    stays valid for the file. Concurrent calls for one file share one upload.
+    """
+    with _nextcloud_links_lock:
+        share_url = _nextcloud_links.get(filename)
+        if share_url:
+            _nextcloud_links.move_to_end(filename)
+            return share_url
+
+    share_url = _nextcloud_shares.do(filename, lambda: _nextcloud_links.get(filename) or create_nextcloud_link(filename))
+    if share_url:
+        with _nextcloud_links_lock:
+            _nextcloud_links[filename] = share_url
+            _nextcloud_links.move_to_end(filename)
+            while len(_nextcloud_links) > NEXTCLOUD_LINK_CACHE_ENTRIES:
+                _nextcloud_links.popitem(last=False)
+    return share_url
+
+def create_local_link(filename, base_url=None):
+    """
+    Returns a signed link to the composite on this app. [share]
+    public_base_url overrides the address the request came in on, since
+    phones scanning the QR code can't reach 127.0.0.1.
+    """
+    base_url = config.get_setting('share', 'public_base_url').strip() or base_url
+    if not base_url:
+        print("错误：本地分享需要在 config.ini 的 [share] public_base_url 中设置本机的局域网地址。")
+        return None
+    if '127.0.0.1' in base_url or 'localhost' in base_url:
+        print(f"警告: 分享链接 {base_url} 只能在本机打开，请设置 [share] public_base_url。")
+    share_url = links.signed_url(base_url, filename, config.get_int_setting('share', 'link_ttl'))
+    print(f"URL: {share_url}")
+    return share_url
+
+def create_nextcloud_link(filename):
+    # 1. 获取共享的Nextcloud客户端（保持连接，复用已知存在的远程目录）
+    client = nextcloud.get_client()
+    if client is None:
+        print("错误：未配置 Nextcloud（WEBDAV_URL、APP_USERNAME、APP_PASSWORD）。")
+        return None
 
-    local_file_path = "uploads/{}".format(filename)  # 图片在Nextcloud中的存储路径
+    local_file_path = storage.path(filename)
 
-    # 2. 通过WebDAV上传图片 (使用WebDAV协议库 requests_toolbelt)
+    # 2. 通过WebDAV上传图片
     remote_directory = 'SciDay' 
     remote_file_name = filename  # 上传后在服务器上的文件名
 
     remote_file_path = f"{remote_directory}/{remote_file_name}"
 
-    options = {
-        'webdav_hostname': webdav_url,
-        'webdav_login': username,
-        'webdav_password': app_password,
-    }
-
     # --- 3. 执行上传操作 ---
     try:
-        # 创建客户端实例
-        client = Client(options)
-
-        # 检查远程目录是否存在，如果不存在则创建它
-        if not client.check(remote_directory):
-            print(f"远程目录 '{remote_directory}' 不存在，正在创建...")
-            client.mkdir(remote_directory)
-            print(f"目录 '{remote_directory}' 创建成功。")
-
-        # 上传文件
-        # upload_sync 会覆盖同名文件
+        # 上传会覆盖同名文件
         print(f"正在上传 '{local_file_path}' 到 '{remote_file_path}'...")
-        client.upload_sync(remote_path=remote_file_path, local_path=local_file_path)
+        client.upload(local_file_path, remote_file_path)
 
         print("文件上传成功！")
 
@@ -258,60 +243,10 @@ def share(filename):
         return None
 
     # 4. 创建公开分享
-    share_url = ""
-    server_url = "https://gdzb.gx.cn"  # Nextcloud服务器的基础URL
-    api_endpoint = f"{server_url}/ocs/v2.php/apps/files_sharing/api/v1/shares"
-
-    headers = {
-        "OCS-APIRequest": "true",
-    }
-
-    data = {
-        "path": f"/{remote_file_path}",  # 注意路径前需要有斜杠
-        "shareType": 3,  # 3表示公开链接分享
-        "permissions": 1,  # 1表示只读权限
-    }
-
     try:
-        # 发送 POST 请求
-        response = requests.post(
-            api_endpoint,
-            headers=headers,
-            data=data,
-            auth=(username, app_password) # requests 库可以直接处理基本认证
-        )
-
-        # 检查响应状态
-        if response.status_code != 200:
-            print(f"请求失败，状态码: {response.status_code}")
-            print(f"响应内容: {response.text}")
-            return None
-
-        # --- 解析响应并提取分享链接 ---
-        root = ET.fromstring(response.content)
-
-        # 检查 OCS API 状态码
-        # --- 更安全地访问元素 ---
-        statuscode_element = root.find('meta/statuscode')
-        if statuscode_element is None:
-            print("错误：在XML响应中未找到 'meta/statuscode' 元素。")
-            print(f"收到的内容: {response.text}")
-            return None
-
-        # Your server returns 200 for success in the XML, not 100
-        if statuscode_element.text == '200':
-            # The path to the URL is data -> url
-            url_element = root.find('data/url')
-            if url_element is not None:
-                share_url = url_element.text
-                print("分享链接创建成功！🎉")
-                print(f"URL: {share_url}")
-            else:
-                print("错误：API报告成功，但在XML中未找到 'data/url' 元素。")
-        else:
-            message = root.find('meta/message').text
-            print(f"创建分享链接失败: {message} (OCS 状态码: {statuscode_element.text})")
-            return None
+        share_url = client.create_public_share(remote_file_path)
+        print("分享链接创建成功！🎉")
+        print(f"URL: {share_url}")
     except requests.exceptions.RequestException as e:
         print(f"API 请求失败: {e}")
         return None
@@ -319,27 +254,7 @@ def share(filename):
         print(f"处理时发生未知错误: {e}")
         return None
 
-    # 4. 生成二维码
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(share_url)
-    qr.make(fit=True)
-
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Generate a unique filename for the QR code
-    import uuid
-    qr_filename = f"qr_code_{uuid.uuid4()}.png"
-    qr_filepath = os.path.join("uploads", qr_filename)
-    
-    img.save(qr_filepath)
-    print(f"二维码已生成并保存到: {qr_filepath}")
-
-    return qr_filename
+    return share_url
 
 if __name__ == "__main__":
     # 测试图片生成功能
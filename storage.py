@@ -0,0 +1,323 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Files under the uploads folder: user photos, generated images and composites.
+
+Filenames stay flat (they appear in URLs and job results), but each file is
+stored as uploads/<kind>/<shard>/<filename>, where the kind comes from the
+filename prefix and the shard is the first hex digits of a hash of the name.
+That keeps every directory small however many files pile up. Files written
+by older versions directly into uploads/ are still found there.
+
+Each kind is deleted once it is older than [storage] <kind>_max_age seconds,
+and the oldest files go first once the kind takes more than <kind>_max_mb.
+A background thread applies these limits every [storage] reap_interval
+seconds. Run this module to look at or clean up the folder by hand:
+
+    python storage.py report
+    python storage.py compact
+"""
+
+import argparse
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+
+import config
+import imagestore
+
+SHARD_CHARS = 2
+TMP_SUFFIX = '.tmp'
+
+# Filename prefix -> kind; everything else is a user photo
+KIND_PREFIXES = (
+    ('composite_', 'composites'),
+    ('generated_image_', 'generated'),
+    ('qr_code_', 'qr'),
+)
+PHOTOS = 'photos'
+KINDS = tuple(kind for _, kind in KIND_PREFIXES) + (PHOTOS,)
+
+StoredFile = namedtuple('StoredFile', ['filename', 'path', 'size', 'mtime'])
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def get_root():
+    return os.path.join(config.get_data_dir(), 'uploads')
+
+
+def kind_of(filename):
+    for prefix, kind in KIND_PREFIXES:
+        if filename.startswith(prefix):
+            return kind
+    return PHOTOS
+
+
+def _check_name(filename):
+    if not filename or filename in ('.', '..') or os.path.basename(filename) != filename:
+        raise ValueError(f"invalid filename: {filename!r}")
+
+
+def _sharded_path(filename):
+    shard = hashlib.sha1(filename.encode('utf-8')).hexdigest()[:SHARD_CHARS]
+    return os.path.join(get_root(), kind_of(filename), shard, filename)
+
+
+def path(filename):
+    """
+    Returns where a file is stored, or where it would be stored if it
+    doesn't exist (yet). Raises ValueError for names that aren't plain
+    filenames.
+    """
+    _check_name(filename)
+    sharded = _sharded_path(filename)
+    if not os.path.exists(sharded):
+        legacy = os.path.join(get_root(), filename)
+        if os.path.isfile(legacy):
+            return legacy
+    return sharded
+
+
+def new_path(filename):
+    """Returns the path to write a new file to, creating its directory."""
+    _check_name(filename)
+    sharded = _sharded_path(filename)
+    os.makedirs(os.path.dirname(sharded), exist_ok=True)
+    return sharded
+
+
+def directory(filename):
+    """
+    Returns the directory to serve filename from. Invalid names get the
+    uploads folder itself, where send_from_directory rejects them.
+    """
+    try:
+        return os.path.dirname(path(filename))
+    except ValueError:
+        return get_root()
+
+
+def exists(filename):
+    try:
+        return os.path.isfile(path(filename))
+    except ValueError:
+        return False
+
+
+def remove(filename):
+    """Deletes a file and drops it from the in-memory image store."""
+    try:
+        os.remove(path(filename))
+    except FileNotFoundError:
+        pass
+    imagestore.get_store().discard(filename)
+
+
+def files(kind, include_tmp=False):
+    """
+    Yields a StoredFile for every file of a kind, including files left
+    directly in uploads/ by older versions.
+    """
+    root = get_root()
+    kind_dir = os.path.join(root, kind)
+    shards = []
+    try:
+        with os.scandir(kind_dir) as it:
+            shards = [entry.path for entry in it if entry.is_dir()]
+    except FileNotFoundError:
+        pass
+    for shard in [root] + shards:
+        try:
+            with os.scandir(shard) as it:
+                for entry in it:
+                    if not entry.is_file() or (shard == root and kind_of(entry.name) != kind):
+                        continue
+                    if entry.name.endswith(TMP_SUFFIX) and not include_tmp:
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield StoredFile(entry.name, entry.path, stat.st_size, stat.st_mtime)
+        except FileNotFoundError:
+            pass
+
+
+def _delete(stored):
+    try:
+        os.remove(stored.path)
+    except FileNotFoundError:
+        return False
+    imagestore.get_store().discard(stored.filename)
+    return True
+
+
+def retention(kind):
+    """Returns (max_age seconds, max_bytes) for a kind; 0 means no limit."""
+    return (config.get_int_setting('storage', f'{kind}_max_age'),
+            config.get_int_setting('storage', f'{kind}_max_mb') * 1024 * 1024)
+
+
+def reap(now=None):
+    """
+    Deletes the files of each kind that are past their retention limits, and
+    temporary files that were abandoned half-written. Returns
+    {kind: (files removed, bytes removed)}.
+    """
+    now = now or time.time()
+    tmp_max_age = config.get_int_setting('storage', 'tmp_max_age')
+    removed = {}
+    for kind in KINDS:
+        max_age, max_bytes = retention(kind)
+        count = size = 0
+        kept = []
+        for stored in files(kind, include_tmp=True):
+            age = now - stored.mtime
+            if stored.filename.endswith(TMP_SUFFIX):
+                # A young temporary file is still being written
+                expired = age > tmp_max_age
+            else:
+                expired = max_age > 0 and age > max_age
+            if not expired:
+                if not stored.filename.endswith(TMP_SUFFIX):
+                    kept.append(stored)
+            elif _delete(stored):
+                count += 1
+                size += stored.size
+
+        if max_bytes > 0:
+            total = sum(stored.size for stored in kept)
+            # Oldest first; composites refresh their mtime when they are used
+            for stored in sorted(kept, key=lambda stored: stored.mtime):
+                if total <= max_bytes:
+                    break
+                total -= stored.size
+                if _delete(stored):
+                    count += 1
+                    size += stored.size
+        if count:
+            removed[kind] = (count, size)
+    return removed
+
+
+def report():
+    """Returns {kind: (files, bytes, oldest mtime or None, files still in the flat layout)}."""
+    root = get_root()
+    summary = {}
+    for kind in KINDS:
+        count = size = legacy = 0
+        oldest = None
+        for stored in files(kind, include_tmp=True):
+            count += 1
+            size += stored.size
+            oldest = stored.mtime if oldest is None else min(oldest, stored.mtime)
+            if os.path.dirname(stored.path) == root:
+                legacy += 1
+        summary[kind] = (count, size, oldest, legacy)
+    return summary
+
+
+def compact():
+    """
+    Moves files from the old flat layout into their shards, applies the
+    retention limits and removes empty shard directories. Returns
+    (files moved, {kind: (files removed, bytes removed)}, directories removed).
+    """
+    root = get_root()
+    moved = 0
+    with os.scandir(root) as it:
+        legacy = [entry.name for entry in it if entry.is_file()]
+    for filename in legacy:
+        try:
+            os.replace(os.path.join(root, filename), new_path(filename))
+            moved += 1
+        except (FileNotFoundError, ValueError):
+            pass
+
+    removed = reap()
+
+    directories = 0
+    for kind in KINDS:
+        kind_dir = os.path.join(root, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        with os.scandir(kind_dir) as it:
+            shards = [entry.path for entry in it if entry.is_dir()]
+        for shard in shards:
+            try:
+                os.rmdir(shard)
+                directories += 1
+            except OSError:
+                # Not empty
+                pass
+    return moved, removed, directories
+
+
+def _format_removed(removed):
+    return ", ".join(f"{kind} {count} 个 ({size / 1024 / 1024:.1f} MB)" for kind, (count, size) in removed.items())
+
+
+def _reap_forever():
+    while True:
+        interval = config.get_int_setting('storage', 'reap_interval')
+        if interval <= 0:
+            return
+        time.sleep(interval)
+        try:
+            removed = reap()
+            if removed:
+                print(f"清理上传文件夹: {_format_removed(removed)}")
+        except Exception as e:
+            print(f"清理上传文件夹失败: {e}")
+
+
+def start_reaper():
+    """Starts the background thread that applies the retention limits, once."""
+    global _reaper
+    if config.get_int_setting('storage', 'reap_interval') <= 0:
+        return
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = threading.Thread(target=_reap_forever, name='storage-reaper', daemon=True)
+            _reaper.start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report on or clean up the uploads folder.")
+    parser.add_argument('command', choices=['report', 'compact'],
+                        help="report: size of each kind of file; "
+                             "compact: move old files into shards and apply the retention limits")
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        moved, removed, directories = compact()
+        print(f"移动了 {moved} 个旧文件，删除了 {directories} 个空目录。")
+        if removed:
+            print(f"删除: {_format_removed(removed)}")
+
+    now = time.time()
+    print(f"{get_root()}:")
+    for kind, (count, size, oldest, legacy) in report().items():
+        max_age, max_bytes = retention(kind)
+        age = f"{(now - oldest) / 3600:8.1f} h" if oldest is not None else "       -  "
+        age_limit = f"max {max_age / 3600:.0f} h" if max_age else "no age limit"
+        size_limit = f"{max_bytes / 1024 / 1024:.0f} MB" if max_bytes else "no size limit"
+        print(f"{kind:>10}  {count:6d} files  {size / 1024 / 1024:9.1f} MB  oldest {age}  "
+              f"{legacy:6d} unsharded  ({age_limit}, {size_limit})")
@@ -0,0 +1,214 @@
+# Copyright (C) 2025 <name of author>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+NextcloudClient uploads against a local WebDAV stand-in that speaks just
+enough of Nextcloud's chunked upload protocol: MKCOL, PUT, PROPFIND and the
+MOVE of <upload folder>/.file that assembles the chunks.
+"""
+
+import posixpath
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlparse
+
+import pytest
+
+import config
+import nextcloud
+
+FILES_ROOT = '/remote.php/dav/files/user'
+UPLOADS_ROOT = '/remote.php/dav/uploads/user'
+CHUNK_SIZE = 4096
+
+
+class WebDAVStub:
+    def __init__(self):
+        self.files = {}
+        self.directories = {'/', '/remote.php', '/remote.php/dav', '/remote.php/dav/files', FILES_ROOT,
+                            '/remote.php/dav/uploads', UPLOADS_ROOT}
+        self.requests = []
+        # Basenames of chunks whose PUT is refused
+        self.failing_chunks = set()
+        self.lock = threading.Lock()
+
+    def children(self, directory):
+        return {path: data for path, data in self.files.items() if posixpath.dirname(path) == directory}
+
+
+def make_handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _path(self):
+            return unquote(urlparse(self.path).path).rstrip('/') or '/'
+
+        def _reply(self, status, body=b''):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _record(self):
+            path = self._path()
+            with stub.lock:
+                stub.requests.append((self.command, path))
+            return path
+
+        def do_MKCOL(self):
+            path = self._record()
+            with stub.lock:
+                if path in stub.directories:
+                    return self._reply(405)
+                if posixpath.dirname(path) not in stub.directories:
+                    return self._reply(409)
+                stub.directories.add(path)
+            self._reply(201)
+
+        def do_PUT(self):
+            path = self._record()
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            with stub.lock:
+                if path.startswith(UPLOADS_ROOT + '/') and posixpath.basename(path) in stub.failing_chunks:
+                    return self._reply(403)
+                if posixpath.dirname(path) not in stub.directories:
+                    return self._reply(409)
+                stub.files[path] = data
+            self._reply(201)
+
+        def do_PROPFIND(self):
+            path = self._record()
+            with stub.lock:
+                if path not in stub.directories:
+                    return self._reply(404)
+                children = stub.children(path)
+            responses = ''.join(
+                f'<d:response><d:href>{quote(child)}</d:href><d:propstat><d:prop>'
+                f'<d:getcontentlength>{len(data)}</d:getcontentlength></d:prop></d:propstat></d:response>'
+                for child, data in children.items())
+            body = f'<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">{responses}</d:multistatus>'
+            self._reply(207, body.encode('utf-8'))
+
+        def do_MOVE(self):
+            path = self._record()
+            upload_directory = posixpath.dirname(path)
+            destination = unquote(urlparse(self.headers['Destination']).path)
+            with stub.lock:
+                if posixpath.dirname(destination) not in stub.directories:
+                    return self._reply(409)
+                chunks = stub.children(upload_directory)
+                data = b''.join(chunks[name] for name in sorted(chunks))
+                if len(data) != int(self.headers['OC-Total-Length']):
+                    return self._reply(400)
+                for name in chunks:
+                    del stub.files[name]
+                stub.directories.discard(upload_directory)
+                stub.files[destination] = data
+            self._reply(201)
+
+    return Handler
+
+
+@pytest.fixture
+def stub():
+    stub = WebDAVStub()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(stub))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    stub.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield stub
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    get_int_setting = config.get_int_setting
+
+    def fake_get_int_setting(section, option):
+        if (section, option) == ('share', 'chunk_size'):
+            return CHUNK_SIZE
+        return get_int_setting(section, option)
+
+    monkeypatch.setattr(config, 'get_int_setting', fake_get_int_setting)
+
+
+def make_client(stub, webdav_path=FILES_ROOT):
+    return nextcloud.NextcloudClient(stub.base_url + webdav_path, 'user', 'password', server_url=stub.base_url)
+
+
+def make_file(tmp_path, size):
+    path = tmp_path / 'composite_test.jpg'
+    path.write_bytes(bytes(index % 251 for index in range(size)))
+    return path
+
+
+def methods(stub, method):
+    return [path for command, path in stub.requests if command == method]
+
+
+def test_small_file_is_sent_in_one_put(stub, tmp_path):
+    local_file = make_file(tmp_path, CHUNK_SIZE - 1)
+
+    make_client(stub).upload(str(local_file), 'SciDay/composite_test.jpg')
+
+    assert stub.files[f'{FILES_ROOT}/SciDay/composite_test.jpg'] == local_file.read_bytes()
+    assert methods(stub, 'PUT') == [f'{FILES_ROOT}/SciDay/composite_test.jpg']
+    assert methods(stub, 'MOVE') == []
+
+
+def test_large_file_is_chunked_and_assembled_with_move(stub, tmp_path):
+    local_file = make_file(tmp_path, CHUNK_SIZE * 2 + 100)
+
+    make_client(stub).upload(str(local_file), 'SciDay/composite_test.jpg')
+
+    assert stub.files[f'{FILES_ROOT}/SciDay/composite_test.jpg'] == local_file.read_bytes()
+    chunk_puts = methods(stub, 'PUT')
+    assert sorted(posixpath.basename(path) for path in chunk_puts) == ['00001', '00002', '00003']
+    assert all(path.startswith(UPLOADS_ROOT + '/') for path in chunk_puts)
+    moves = methods(stub, 'MOVE')
+    assert len(moves) == 1 and moves[0].endswith('/.file')
+    # The upload folder is gone once the file is assembled
+    assert not any(path.startswith(UPLOADS_ROOT + '/') for path in stub.files)
+
+
+def test_failed_upload_resumes_with_the_missing_chunks(stub, tmp_path):
+    local_file = make_file(tmp_path, CHUNK_SIZE * 3)
+    client = make_client(stub)
+
+    stub.failing_chunks = {'00002'}
+    with pytest.raises(nextcloud.NextcloudError):
+        client.upload(str(local_file), 'SciDay/composite_test.jpg')
+    assert f'{FILES_ROOT}/SciDay/composite_test.jpg' not in stub.files
+
+    stub.failing_chunks = set()
+    stub.requests.clear()
+    client.upload(str(local_file), 'SciDay/composite_test.jpg')
+
+    # Chunks 1 and 3 made it the first time and are not sent again
+    assert [posixpath.basename(path) for path in methods(stub, 'PUT')] == ['00002']
+    assert len(methods(stub, 'MOVE')) == 1
+    assert stub.files[f'{FILES_ROOT}/SciDay/composite_test.jpg'] == local_file.read_bytes()
+
+
+def test_legacy_webdav_endpoint_uses_a_single_put(stub, tmp_path):
+    stub.directories.add('/remote.php/webdav')
+    local_file = make_file(tmp_path, CHUNK_SIZE * 2)
+
+    make_client(stub, '/remote.php/webdav').upload(str(local_file), 'composite_test.jpg')
+
+    assert methods(stub, 'PUT') == ['/remote.php/webdav/composite_test.jpg']
+    assert stub.files['/remote.php/webdav/composite_test.jpg'] == local_file.read_bytes()